@@ -3,11 +3,23 @@ import requests
 import os
 import time
 import hashlib
+import re
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 from openai import OpenAI
 from PIL import Image
 from io import BytesIO
 from tavily import TavilyClient
+from imdb_index import get_imdb_index
+from rate_limiter import get_limiter, RateLimitTimeout
+from deadline import DEADLINE_AI_POSTER_MIN_SECONDS, DEADLINE_POSTER_MIN_SECONDS
+from metrics import span
 from dotenv import load_dotenv
 
 # 加载.env文件中的环境变量
@@ -19,8 +31,13 @@ client = OpenAI(
     api_key= os.getenv("DASHSCOPE_API_KEY")
 )
 
-# 对话历史
-history = []
+# 对话历史配置，每个Gradio会话单独保存历史记录
+DEFAULT_SESSION = "default"  # 未指定会话时（如命令行调试）使用的会话
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))  # 每个会话历史记录的估算token预算
+HISTORY_DIGEST_FALLBACK_CHARS = 200  # 无法解析出电影时，助手回复摘要保留的字符数
+HISTORY_SESSION_IDLE_SECONDS = float(os.getenv("HISTORY_SESSION_IDLE_SECONDS", "1800"))  # 空闲会话过期时间(秒)
+HISTORY_MAX_TOTAL_CHARS = int(os.getenv("HISTORY_MAX_TOTAL_CHARS", "2000000"))         # 全部会话历史在内存中的总字符数上限
+HISTORY_SPILL_DIR = os.getenv("HISTORY_SPILL_DIR", "")  # 设置后，超出内存上限的冷会话写入该目录而不是直接丢弃
 
 # 全局系统提示词
 SYSTEM_PROMPT = """你是一个专业的电影推荐专家。请按照以下规则推荐电影：
@@ -43,51 +60,385 @@ SYSTEM_PROMPT = """你是一个专业的电影推荐专家。请按照以下规
 # 搜索相关配置
 CACHE_DIR = "tavily_cache"
 os.makedirs(CACHE_DIR, exist_ok=True)
+TAVILY_CACHE_DB = os.path.join(CACHE_DIR, "tavily_cache.sqlite3")
+TAVILY_CACHE_MAX_MB = float(os.getenv("TAVILY_CACHE_MAX_MB", "50"))                              # 缓存容量上限(MB)
+TAVILY_CACHE_COMPRESS = os.getenv("TAVILY_CACHE_COMPRESS", "true").lower() in ("1", "true", "yes")  # 是否压缩缓存内容
+TAVILY_MEMORY_CACHE_ITEMS = int(os.getenv("TAVILY_MEMORY_CACHE_ITEMS", "256"))      # 内存热缓存条目数
+TAVILY_MEMORY_CACHE_TTL = float(os.getenv("TAVILY_MEMORY_CACHE_TTL", "3600"))       # 内存热缓存过期时间(秒)
+TAVILY_CONTEXT_CHAR_BUDGET = int(os.getenv("TAVILY_CONTEXT_CHAR_BUDGET", "1200"))   # 注入提示词的搜索上下文总字符数上限
+TAVILY_SNIPPET_MAX_CHARS = int(os.getenv("TAVILY_SNIPPET_MAX_CHARS", "300"))       # 单条搜索片段的最大字符数
+SNIPPET_DUPLICATE_THRESHOLD = 0.6  # 两条片段的字符二元组重合度超过该值时视为重复
+TAVILY_CACHE_DURATION = {
+    "recent": 24,    # 最新电影信息缓存24小时
+    "classic": 168   # 经典电影信息缓存7天(168小时)
+}
 
-def get_messages_with_history(user_prompt):
-    """获取包含系统提示和历史记录的完整消息列表"""
-    # 始终以系统提示开始
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+# OMDb元数据缓存配置
+OMDB_CACHE_DIR = "omdb_cache"
+OMDB_CACHE_TTL_HOURS = float(os.getenv("OMDB_CACHE_TTL_HOURS", "720"))                   # 命中结果缓存30天
+OMDB_NEGATIVE_CACHE_TTL_HOURS = float(os.getenv("OMDB_NEGATIVE_CACHE_TTL_HOURS", "6"))   # 未找到的结果缓存6小时
+os.makedirs(OMDB_CACHE_DIR, exist_ok=True)
+
+# 海报图片缓存配置
+POSTER_CACHE_DIR = "poster_cache"
+POSTER_CACHE_MAX_MB = float(os.getenv("POSTER_CACHE_MAX_MB", "200"))           # 磁盘缓存容量上限(MB)
+POSTER_MEMORY_CACHE_ITEMS = int(os.getenv("POSTER_MEMORY_CACHE_ITEMS", "64"))  # 内存中保留的已解码海报数量
+
+# AI生成海报缓存配置（按电影身份缓存，避免重复生成）
+AI_POSTER_CACHE_DIR = "ai_poster_cache"
+AI_POSTER_CACHE_MAX_MB = float(os.getenv("AI_POSTER_CACHE_MAX_MB", "500"))
+
+# HTTP连接池配置，可在.env中覆盖
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))   # 连接超时(秒)
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "20"))        # 读取超时(秒)
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "10"))              # 缓存的主机连接池数量
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))                # 每个主机的最大keep-alive连接数
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))             # 最大重试次数
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))     # 重试退避系数(秒)
+# AI生成图片耗时较长，单独设置读取超时
+IMAGE_GENERATION_READ_TIMEOUT = float(os.getenv("IMAGE_GENERATION_READ_TIMEOUT", "120"))
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """获取全局共享的HTTP会话（按主机复用连接池，支持keep-alive和带退避的重试）"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                retry = Retry(
+                    total=HTTP_MAX_RETRIES,
+                    backoff_factor=HTTP_RETRY_BACKOFF,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset(["GET", "HEAD"]),  # POST非幂等，只在连接失败时重试
+                    respect_retry_after_header=True,
+                    raise_on_status=False  # 重试耗尽后返回最后的响应，由调用方检查状态码
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_HOSTS,
+                    pool_maxsize=HTTP_POOL_SIZE,
+                    max_retries=retry
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _http_session = session
+    return _http_session
+
+def http_get(url, timeout=None, **kwargs):
+    """通过共享连接池发送GET请求，默认使用连接/读取超时"""
+    timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    return get_http_session().get(url, timeout=timeout, **kwargs)
+
+def get_request_timeout(deadline=None, read_timeout=HTTP_READ_TIMEOUT):
+    """获取(连接, 读取)超时，传入请求截止时间时不超过其剩余时间"""
+    if deadline is None:
+        return (HTTP_CONNECT_TIMEOUT, read_timeout)
+    return (deadline.limit(HTTP_CONNECT_TIMEOUT), deadline.limit(read_timeout))
+
+def http_post(url, timeout=None, **kwargs):
+    """通过共享连接池发送POST请求，默认使用连接/读取超时"""
+    timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    return get_http_session().post(url, timeout=timeout, **kwargs)
+
+class SessionHistoryStore:
+    """按会话保存对话历史：线程安全，空闲会话自动过期，全部会话受内存上限约束，冷会话可写入磁盘"""
     
-    # 添加历史对话记录
-    if history:
-        messages.extend(history)
-        print(f"【调试信息】历史记录已读取: 当前有 {len(history)} 条历史消息")
-    else:
-        print("【调试信息】历史记录为空，这是新对话")
+    # 两次空闲会话清理之间的最小间隔(秒)
+    SWEEP_INTERVAL = 60
     
-    # 添加当前用户提示
-    messages.append({"role": "user", "content": user_prompt})
+    def __init__(self, idle_seconds, max_total_chars, spill_dir=None):
+        """
+        参数:
+            idle_seconds: 会话空闲多久后过期(秒)
+            max_total_chars: 全部会话历史在内存中的总字符数上限
+            spill_dir: 冷会话的磁盘目录，为空时超出上限的会话直接丢弃
+        """
+        self.idle_seconds = idle_seconds
+        self.max_total_chars = max_total_chars
+        self.spill_dir = spill_dir
+        self._sessions = OrderedDict()  # 会话ID -> {"messages": [...], "last_access": 时间, "chars": 字符数}
+        self._total_chars = 0
+        self._last_sweep = time.time()
+        self._lock = threading.RLock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+    
+    @staticmethod
+    def _count_chars(messages):
+        return sum(len(message["content"]) for message in messages)
+    
+    def _get_spill_path(self, session_id):
+        """获取冷会话的磁盘文件路径"""
+        return os.path.join(self.spill_dir, f"{hashlib.md5(session_id.encode('utf-8')).hexdigest()}.json")
     
-    return messages
+    def _spill(self, session_id, session):
+        """将会话写入磁盘（调用方需持有锁）"""
+        try:
+            with open(self._get_spill_path(session_id), 'w', encoding='utf-8') as f:
+                json.dump(session, f, ensure_ascii=False)
+        except OSError as e:
+            print(f"【调试信息】会话历史写入磁盘失败: {e}")
+    
+    def _load_spilled(self, session_id):
+        """从磁盘读取冷会话，读取后删除文件；不存在或已过期时返回None（调用方需持有锁）"""
+        path = self._get_spill_path(session_id)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                session = json.load(f)
+            os.remove(path)
+        except (OSError, ValueError):
+            return None
+        if time.time() - session.get("last_access", 0) > self.idle_seconds:
+            return None
+        return session
+    
+    def _remove(self, session_id, spill):
+        """从内存移除会话，spill为True且配置了磁盘目录时写入磁盘（调用方需持有锁）"""
+        session = self._sessions.pop(session_id)
+        self._total_chars -= session["chars"]
+        if spill and self.spill_dir:
+            self._spill(session_id, session)
+    
+    def _get_session(self, session_id, create=True):
+        """获取会话并更新访问时间（调用方需持有锁）"""
+        self._sweep()
+        session = self._sessions.get(session_id)
+        if session is None and self.spill_dir:
+            session = self._load_spilled(session_id)
+            if session is not None:
+                self._sessions[session_id] = session
+                self._total_chars += session["chars"]
+                print(f"【调试信息】已从磁盘恢复会话历史: {session_id}")
+                self._enforce_memory_limit(session_id)
+        if session is None:
+            if not create:
+                return None
+            session = {"messages": [], "last_access": time.time(), "chars": 0}
+            self._sessions[session_id] = session
+        session["last_access"] = time.time()
+        self._sessions.move_to_end(session_id)
+        return session
+    
+    def _sweep(self):
+        """清理空闲过期的会话（调用方需持有锁）"""
+        now = time.time()
+        if now - self._last_sweep < self.SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        
+        expired = [sid for sid, session in self._sessions.items() if now - session["last_access"] > self.idle_seconds]
+        for session_id in expired:
+            self._remove(session_id, spill=False)
+        if expired:
+            print(f"【调试信息】已清理 {len(expired)} 个空闲会话的历史记录")
+        
+        if self.spill_dir:
+            for entry in os.scandir(self.spill_dir):
+                try:
+                    if now - entry.stat().st_mtime > self.idle_seconds:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+    
+    def _enforce_memory_limit(self, keep_session_id):
+        """超出内存上限时移出最久未访问的会话（调用方需持有锁）"""
+        while self._total_chars > self.max_total_chars and len(self._sessions) > 1:
+            session_id = next(iter(self._sessions))
+            if session_id == keep_session_id:
+                break
+            self._remove(session_id, spill=True)
+            print(f"【调试信息】会话历史超出内存上限，已移出会话: {session_id}")
+    
+    def get_messages(self, session_id):
+        """获取会话历史消息的副本"""
+        with self._lock:
+            session = self._get_session(session_id, create=False)
+            return list(session["messages"]) if session else []
+    
+    def append(self, session_id, message, max_tokens):
+        """
+        添加消息到会话历史
+        
+        参数:
+            max_tokens: 会话历史的估算token预算，超出时删除最早的消息
+        
+        返回:
+            list: 因超出预算被删除的消息
+        """
+        with self._lock:
+            session = self._get_session(session_id)
+            messages = session["messages"]
+            messages.append(message)
+            if "fork_new" in session:
+                session["fork_new"].append(message)
+            removed = []
+            # 成对删除最早的消息，保持对话完整性，至少保留最新的一条
+            while len(messages) > 1 and sum(estimate_tokens(m["content"]) for m in messages) > max_tokens:
+                count = min(2, len(messages) - 1)
+                removed.extend(messages[:count])
+                del messages[:count]
+            chars = self._count_chars(messages)
+            self._total_chars += chars - session["chars"]
+            session["chars"] = chars
+            self._enforce_memory_limit(session_id)
+            return removed
+    
+    def annotate_last(self, session_id, role, suffix):
+        """在会话中最后一条指定角色的消息末尾追加内容，返回是否找到该消息"""
+        with self._lock:
+            session = self._get_session(session_id, create=False)
+            if not session:
+                return False
+            for message in reversed(session["messages"]):
+                if message["role"] == role:
+                    message["content"] += suffix
+                    session["chars"] += len(suffix)
+                    self._total_chars += len(suffix)
+                    return True
+            return False
+    
+    def fork(self, session_id, fork_id):
+        """
+        复制会话历史到临时会话，后台预取在临时会话上进行，不影响真实会话
+        
+        返回:
+            int: 复制的消息数
+        """
+        with self._lock:
+            source = self._get_session(session_id, create=False)
+            messages = [dict(message) for message in source["messages"]] if source else []
+            if fork_id in self._sessions:
+                self._remove(fork_id, spill=False)
+            session = self._get_session(fork_id)
+            session["messages"] = messages
+            session["fork_new"] = []  # 临时会话中新增的消息，合并时只追加这些消息
+            session["chars"] = self._count_chars(messages)
+            self._total_chars += session["chars"]
+            self._enforce_memory_limit(fork_id)
+            return len(messages)
+    
+    def pop_fork(self, fork_id):
+        """删除临时会话，返回其中新增的消息"""
+        with self._lock:
+            session = self._sessions.get(fork_id)
+            if session is None:
+                return []
+            self._remove(fork_id, spill=False)
+            return session.get("fork_new", [])
+    
+    def clear(self, session_id):
+        """清空会话历史，返回删除的消息数"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None and self.spill_dir:
+                session = self._load_spilled(session_id)
+                return len(session["messages"]) if session else 0
+            if session is None:
+                return 0
+            self._remove(session_id, spill=False)
+            return len(session["messages"])
+
+# 创建全局会话历史存储
+history_store = SessionHistoryStore(HISTORY_SESSION_IDLE_SECONDS, HISTORY_MAX_TOTAL_CHARS, HISTORY_SPILL_DIR or None)
+
+def estimate_tokens(text):
+    """粗略估算文本的token数：中日韩字符按每字1个token，其余字符按每4个字符1个token"""
+    cjk_chars = sum(1 for char in text if '\u2e80' <= char <= '\u9fff' or '\uff00' <= char <= '\uffef')
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+def compact_assistant_reply(content):
+    """将助手回复压缩为推荐摘要（电影标题、类型、年份），避免完整的描述和理由占用历史记录"""
+    parser = IncrementalMovieParser()
+    movies = parser.feed(content)
+    if not movies:
+        return content[:HISTORY_DIGEST_FALLBACK_CHARS]
+    
+    items = []
+    for movie in movies:
+        details = "，".join(str(movie[field]) for field in ("genre", "year") if movie.get(field))
+        items.append(f"{movie.get('title', '未知')}（{details}）" if details else movie.get('title', '未知'))
+    return "【推荐摘要】已推荐：" + "；".join(items)
+
+def get_messages_with_history(user_prompt, session_id=None):
+    """获取包含系统提示和指定会话历史记录的完整消息列表"""
+    with span("history") as stage:
+        session_id = session_id or DEFAULT_SESSION
+        # 始终以系统提示开始
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    
+        # 添加历史对话记录
+        history = history_store.get_messages(session_id)
+        if history:
+            messages.extend(history)
+            print(f"【调试信息】历史记录已读取: 当前有 {len(history)} 条历史消息")
+        else:
+            print("【调试信息】历史记录为空，这是新对话")
+    
+        # 添加当前用户提示
+        messages.append({"role": "user", "content": user_prompt})
+    
+        # 记录本次请求的提示词规模
+        history_tokens = sum(estimate_tokens(message["content"]) for message in history)
+        prompt_tokens = estimate_tokens(user_prompt)
+        system_tokens = estimate_tokens(SYSTEM_PROMPT)
+        print(f"【调试信息】本次提示词约 {system_tokens + history_tokens + prompt_tokens} tokens"
+              f"（系统提示 {system_tokens}，历史记录 {history_tokens}，当前提示 {prompt_tokens}）")
+    
+        stage["messages"] = len(messages)
+        stage["tokens"] = system_tokens + history_tokens + prompt_tokens
+        return messages
 
 # 添加消息到历史记录
-def add_to_history(role, content):
-    """将新消息添加到对话历史"""
+def add_to_history(role, content, session_id=None):
+    """将新消息添加到指定会话的对话历史，助手回复会先压缩为推荐摘要"""
     # 系统消息不添加到历史记录中
-    if role != "system":
-        history.append({"role": role, "content": content})
-        # 截断内容以避免打印过长
-        content_preview = content[:50] + "..." if len(content) > 50 else content
-        print(f"【调试信息】已添加到历史记录: {role} - {content_preview}")
+    if role == "system":
+        return
+    
+    session_id = session_id or DEFAULT_SESSION
+    if role == "assistant":
+        compacted = compact_assistant_reply(content)
+        print(f"【调试信息】助手回复已压缩: 约 {estimate_tokens(content)} -> {estimate_tokens(compacted)} tokens")
+        content = compacted
+    removed_messages = history_store.append(session_id, {"role": role, "content": content}, HISTORY_TOKEN_BUDGET)
+    # 截断内容以避免打印过长
+    content_preview = content[:50] + "..." if len(content) > 50 else content
+    print(f"【调试信息】已添加到历史记录: {role} - {content_preview}")
     
     # 保持历史记录在合理长度，避免过长
-    if len(history) > 10:  # 保留最近的5轮对话(10条消息)
-        removed = history.pop(0)
+    for removed in removed_messages:
         removed_preview = removed["content"][:30] + "..." if len(removed["content"]) > 30 else removed["content"]
-        print(f"【调试信息】历史记录已满，删除最早消息: {removed['role']} - {removed_preview}")
-        
-        if history:  # 确保还有消息可以删除
-            removed = history.pop(0)
-            removed_preview = removed["content"][:30] + "..." if len(removed["content"]) > 30 else removed["content"]
-            print(f"【调试信息】保持对话完整性，删除第二条消息: {removed['role']} - {removed_preview}")
+        print(f"【调试信息】历史记录超出token预算，删除最早消息: {removed['role']} - {removed_preview}")
+
+def record_user_reaction(reaction, session_id=None):
+    """将用户对上一轮推荐的反应记录到对应的推荐摘要中"""
+    if history_store.annotate_last(session_id or DEFAULT_SESSION, "assistant", f"（用户反应：{reaction}）"):
+        print(f"【调试信息】已记录用户反应: {reaction}")
+
+def fork_history(session_id, fork_id):
+    """复制会话历史到临时会话"""
+    count = history_store.fork(session_id or DEFAULT_SESSION, fork_id)
+    print(f"【调试信息】已复制 {count} 条历史消息到临时会话: {fork_id}")
+
+def adopt_fork_history(fork_id, session_id=None):
+    """将临时会话中新增的消息合并到真实会话，并删除临时会话"""
+    session_id = session_id or DEFAULT_SESSION
+    messages = history_store.pop_fork(fork_id)
+    for message in messages:
+        for removed in history_store.append(session_id, message, HISTORY_TOKEN_BUDGET):
+            print(f"【调试信息】历史记录超出token预算，删除最早消息: {removed['role']} - {removed['content'][:30]}...")
+    print(f"【调试信息】已合并临时会话的 {len(messages)} 条消息: {fork_id}")
+
+def discard_fork_history(fork_id):
+    """删除临时会话，不合并其中的消息"""
+    history_store.pop_fork(fork_id)
 
 # 清空历史记录
-def clear_history():
-    """清空对话历史"""
-    global history
-    history_length = len(history)
-    history = []
+def clear_history(session_id=None):
+    """清空指定会话的对话历史"""
+    history_length = history_store.clear(session_id or DEFAULT_SESSION)
     print(f"【调试信息】历史记录已清空，共删除了 {history_length} 条消息")
 
 def extract_json_content(input_str):
@@ -112,6 +463,112 @@ def extract_json_content(input_str):
 
     return input_str.strip()
 
+class IncrementalMovieParser:
+    """
+    流式输出的增量解析器：实时丢弃<think>推理内容，
+    movie_recommendations数组中的每个电影对象一闭合就立即解析出来
+    """
+    
+    THINK_START = '<think>'
+    THINK_END = '</think>'
+    
+    def __init__(self):
+        self.text = ""              # 去除推理内容后的正文
+        self._pending = ""          # 尚未处理的原始输出（可能包含被截断的标签）
+        self._in_think = False
+        self._array_found = False
+        self._array_closed = False
+        self._pos = 0               # 正文中已扫描到的位置
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._object_start = -1
+    
+    def feed(self, chunk):
+        """
+        输入一段流式输出
+        
+        返回:
+            list: 本次新解析出的电影对象
+        """
+        self._pending += chunk
+        self.text += self._strip_think()
+        return self._scan()
+    
+    def _strip_think(self):
+        """从待处理内容中去除<think>...</think>部分，返回可确定的正文"""
+        visible = ""
+        while self._pending:
+            if self._in_think:
+                end = self._pending.find(self.THINK_END)
+                if end == -1:
+                    # 保留可能被截断的结束标签
+                    self._pending = self._pending[-(len(self.THINK_END) - 1):]
+                    return visible
+                self._pending = self._pending[end + len(self.THINK_END):]
+                self._in_think = False
+            else:
+                start = self._pending.find(self.THINK_START)
+                if start != -1:
+                    visible += self._pending[:start]
+                    self._pending = self._pending[start + len(self.THINK_START):]
+                    self._in_think = True
+                    continue
+                # 末尾可能是被截断的开始标签，暂不输出
+                keep = 0
+                for size in range(1, len(self.THINK_START)):
+                    if self._pending.endswith(self.THINK_START[:size]):
+                        keep = size
+                visible += self._pending[:len(self._pending) - keep]
+                self._pending = self._pending[len(self._pending) - keep:]
+                return visible
+        return visible
+    
+    def _scan(self):
+        """扫描新增正文，返回闭合的电影对象"""
+        movies = []
+        if self._array_closed:
+            return movies
+        
+        if not self._array_found:
+            key_index = self.text.find('"movie_recommendations"')
+            if key_index == -1:
+                return movies
+            bracket = self.text.find('[', key_index)
+            if bracket == -1:
+                return movies
+            self._array_found = True
+            self._pos = bracket + 1
+        
+        text = self.text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                if self._depth == 0:
+                    self._object_start = i
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        movies.append(json.loads(text[self._object_start:i + 1]))
+                    except json.JSONDecodeError as e:
+                        print(f"【调试信息】增量解析电影对象失败: {e}")
+            elif char == ']' and self._depth == 0:
+                self._array_closed = True
+                break
+        self._pos = len(text)
+        return movies
+
 # 创建带系统提示的对话历史
 def create_messages_with_system_prompt(user_prompt):
     """创建包含系统提示的消息列表"""
@@ -120,8 +577,26 @@ def create_messages_with_system_prompt(user_prompt):
         {"role": "user", "content": user_prompt}
     ]
 
-def generate_image_ByAI(prompt: str) -> Image:
-    """使用AI生成图像"""
+def get_movie_json_template(count):
+    """生成要求返回count部电影的JSON格式模板，只给出一个示例条目以节省提示词"""
+    return f"""
+{{
+  "movie_recommendations": [
+    {{
+      "title": "电影标题",
+      "genre": "电影类型",
+      "year": "年份",
+      "description": "电影描述",
+      "reason": "推荐理由",
+      "rating": "评分"
+    }}
+    （共{count}部电影，每部格式相同，按推荐程度从高到低排列）
+  ]
+}}
+"""
+
+def generate_image_bytes(prompt: str, deadline=None) -> bytes:
+    """使用AI生成图像，返回原始图片字节；传入请求截止时间时，排队和下载都不超过其剩余时间"""
     url = "https://api-inference.modelscope.cn/v1/images/generations"
     payload = {
         "model": 'MusePublic/489_ckpt_FLUX_1',  # ModelScope Model-Id
@@ -132,15 +607,28 @@ def generate_image_ByAI(prompt: str) -> Image:
         "Content-Type": "application/json"
     }
 
-    response = requests.post(url, data=json.dumps(payload, ensure_ascii=False).encode('utf-8'), headers=headers)
+    limiter = get_limiter("modelscope_image")
+    with limiter.limit(deadline=deadline):
+        response = http_post(
+            url,
+            data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+            headers=headers,
+            timeout=get_request_timeout(deadline, IMAGE_GENERATION_READ_TIMEOUT)
+        )
+    if response.status_code == 429:
+        limiter.throttle(response.headers.get("Retry-After"))
     response.raise_for_status()  # Raises an HTTPError for bad responses
 
     response_data = response.json()
     image_url = response_data['images'][0]['url']
-    image_response = requests.get(image_url)
+    image_response = http_get(image_url, timeout=get_request_timeout(deadline))
     image_response.raise_for_status()  # Raises an HTTPError for bad responses
 
-    image = Image.open(BytesIO(image_response.content))
+    return image_response.content
+
+def generate_image_ByAI(prompt: str) -> Image:
+    """使用AI生成图像"""
+    image = Image.open(BytesIO(generate_image_bytes(prompt)))
     return image
 
 def extract_english_title(movie_title):
@@ -176,72 +664,726 @@ def get_imdb_url(movie_data):
     else:
         return "IMDb ID not found"
 
-def get_movie_poster(movie_name):
-    """从OMDb API获取电影海报"""
-    # OMDb API的URL，使用电影名称和API密钥进行查询
-    apikey=os.getenv("OMDB_API_KEY")
+def get_lookup_title(movie_name):
+    """从"中文标题(英文标题)"格式中取出用于OMDb查询的标题"""
     movie_name_en = extract_english_title(movie_name)
     movie_name_cn = extract_english_title2(movie_name)
     
     # 确保 movie_name_en 不为空
     if movie_name_en:
-        movie_name = movie_name_en
+        return movie_name_en.strip()
     elif movie_name_cn:
-        movie_name = movie_name_cn
+        return movie_name_cn.strip()
     else:
-        movie_name = movie_name.split('(')[0].strip()  # 如果没有英文标题，使用中文标题
+        return movie_name.split('(')[0].strip()  # 如果没有英文标题，使用中文标题
+
+def normalize_title_key(title):
+    """规范化查询标题，作为缓存键（忽略大小写和多余空白）"""
+    return " ".join(title.lower().split())
+
+def get_year_key(year):
+    """从年份字段（如"2021"、"2021年"）中取出四位年份，没有时返回空字符串"""
+    match = re.search(r'\d{4}', str(year or ""))
+    return match.group(0) if match else ""
+
+def get_omdb_cache_key(title_key, year=None):
+    """按标题查询OMDb的缓存键：有年份时带上年份，同名不同年份的电影（如1984年和2021年的Dune）分别缓存"""
+    year_key = get_year_key(year)
+    return f"{title_key}|{year_key}" if year_key else title_key
+
+def _get_omdb_cache_path(title_key):
+    """获取OMDb缓存文件路径"""
+    hash_obj = hashlib.md5(title_key.encode('utf-8'))
+    return os.path.join(OMDB_CACHE_DIR, f"{hash_obj.hexdigest()}.json")
+
+def _get_omdb_from_cache(title_key):
+    """
+    从缓存读取OMDb查询结果
+    
+    返回:
+        tuple: (是否命中, 数据)。负缓存命中时数据为None
+    """
+    cache_path = _get_omdb_cache_path(title_key)
+    if not os.path.exists(cache_path):
+        return False, None
+    
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache_data = json.load(f)
+        
+        # 命中结果和未找到结果使用不同的缓存时长
+        negative = cache_data.get('negative', False)
+        cache_hours = OMDB_NEGATIVE_CACHE_TTL_HOURS if negative else OMDB_CACHE_TTL_HOURS
+        cache_time = datetime.fromisoformat(cache_data.get('timestamp', '2000-01-01T00:00:00'))
+        if datetime.now() - cache_time > timedelta(hours=cache_hours):
+            print(f"[OMDb] 缓存已过期: {title_key}")
+            return False, None
+        
+        return True, cache_data.get('data')
+    except Exception as e:
+        print(f"[OMDb] 读取缓存失败: {str(e)}")
+        return False, None
+
+def _save_omdb_to_cache(title_key, data):
+    """保存OMDb查询结果到缓存，data为None表示未找到该电影（负缓存）"""
+    cache_path = _get_omdb_cache_path(title_key)
+    cache_data = {
+        'timestamp': datetime.now().isoformat(),
+        'title': title_key,
+        'negative': data is None,
+        'data': data
+    }
     
-    # 修改为使用完整的电影名称格式
-    movie_name = movie_name.replace(" ", "+")
+    try:
+        # 先写临时文件再替换，避免并发读取到写了一半的文件
+        tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache_data, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"[OMDb] 保存缓存失败: {str(e)}")
+
+def _get_local_metadata(imdb_match):
+    """将本地IMDb索引的查询结果转换为OMDb格式（没有海报），OMDb不可用时兜底"""
+    return {
+        "imdbID": imdb_match["imdb_id"],
+        "Year": str(imdb_match["year"] or "N/A"),
+        "imdbRating": str(imdb_match["rating"] or "N/A"),
+        "imdbVotes": str(imdb_match["votes"]),
+        "Poster": "N/A",
+        "Response": "True"
+    }
+
+def get_movie_metadata(movie_name, year=None, deadline=None):
+    """
+    从OMDb API获取电影的完整元数据（海报、imdbID、年份、评分等），优先使用本地缓存
     
-    print("电影名称是：", movie_name)
-    url = f"http://www.omdbapi.com/?t={movie_name}&apikey={apikey}"
+    参数:
+        movie_name: 电影标题，"中文标题(英文标题)"格式
+        year: 上映年份，用于在本地IMDb索引中区分同名电影
+        deadline: 请求的截止时间，已超时时只查缓存
     
-    # 发送GET请求
-    response = requests.get(url)
+    返回:
+        dict: OMDb返回的完整数据；未找到或请求失败时返回None
+    """
+    lookup_title = get_lookup_title(movie_name)
+    title_key = normalize_title_key(lookup_title)
+    if not title_key:
+        return None
+    cache_key = get_omdb_cache_key(title_key, year)
     
-    # 检查请求是否成功
-    if response.status_code == 200:
-        data = response.json()
-        
-        # 检查API返回的数据是否包含海报信息
-        if data.get("Response") == "True":
-            poster_url = data.get("Poster")  # 获取海报URL
-            imdb_url = get_imdb_url(data)  # 获取IMDb URL
-            print("成功获取海报和IMDb URL！")
-            return poster_url or "N/A", imdb_url
-        else:
-            print(f"未找到电影 {movie_name} 的海报或其他信息。")
-            return "N/A", "无法找到电影网址，请重试"
+    with span("omdb") as stage:
+        hit, data = _get_omdb_from_cache(cache_key)
+        if hit:
+            print(f"[OMDb] 使用缓存结果: '{lookup_title}'{'（未找到）' if data is None else ''}")
+            stage["outcome"] = "cache_hit"
+            return data
+        if deadline is not None and deadline.expired():
+            print(f"[OMDb] 超出请求时间预算，跳过查询: '{lookup_title}'")
+            stage["outcome"] = "skipped"
+            return None
+    
+        # 相同电影的并发查询合并为一次请求
+        data = omdb_flight.do(cache_key, _fetch_movie_metadata, lookup_title, cache_key, year, deadline, deadline=deadline)
+        stage["outcome"] = "miss" if data else "not_found"
+        return data
+
+def _fetch_movie_metadata(lookup_title, cache_key, year=None, deadline=None):
+    """向OMDb查询电影元数据并写入缓存（按标题和年份，以及imdbID），未找到或请求失败时返回None"""
+    # 先在本地IMDb索引中解析imdbID，标题写法不同的同一部电影共用按imdbID缓存的结果
+    imdb_index = get_imdb_index()
+    imdb_match = imdb_index.lookup(lookup_title, year) if imdb_index else None
+    if imdb_match:
+        hit, data = _get_omdb_from_cache(imdb_match["imdb_id"])
+        if hit and data:
+            print(f"[OMDb] 本地索引解析为 {imdb_match['imdb_id']}，使用缓存结果")
+            _save_omdb_to_cache(cache_key, data)
+            return data
+    
+    print("电影名称是：", lookup_title)
+    if imdb_match:
+        params = {"i": imdb_match["imdb_id"], "apikey": os.getenv("OMDB_API_KEY")}
     else:
+        params = {"t": lookup_title, "apikey": os.getenv("OMDB_API_KEY")}
+        if get_year_key(year):
+            params["y"] = get_year_key(year)
+    
+    # 发送GET请求，按OMDb配额排队
+    limiter = get_limiter("omdb")
+    try:
+        with limiter.limit(deadline=deadline):
+            response = http_get("http://www.omdbapi.com/", params=params, timeout=get_request_timeout(deadline))
+    except (requests.exceptions.RequestException, RateLimitTimeout) as e:
+        print(f"请求OMDb失败: {e}")
+        return _get_local_metadata(imdb_match) if imdb_match else None
+    
+    # 检查请求是否成功
+    if response.status_code == 429:
+        limiter.throttle(response.headers.get("Retry-After"))
+    if response.status_code != 200:
         print(f"请求失败，状态码: {response.status_code}")
+        return _get_local_metadata(imdb_match) if imdb_match else None
+    
+    data = response.json()
+    if data.get("Response") == "True":
+        _save_omdb_to_cache(cache_key, data)
+        if data.get("imdbID"):
+            _save_omdb_to_cache(data["imdbID"], data)
+        return data
+    
+    print(f"未找到电影 {lookup_title} 的海报或其他信息。")
+    # 只对"未找到电影"做负缓存，密钥无效、超出配额等错误不缓存
+    if data.get("Error") == "Movie not found!":
+        _save_omdb_to_cache(cache_key, None)
+    return None
+
+# get_movie_poster未传入OMDb数据时的默认值，与"已查询但未找到"的None区分
+_METADATA_NOT_FETCHED = object()
+
+def get_movie_poster(movie_name, data=_METADATA_NOT_FETCHED):
+    """
+    从OMDb API获取电影海报
+    
+    参数:
+        data: 已获取的OMDb数据，传入时（包括未找到时的None）不再重复查询
+    """
+    if data is _METADATA_NOT_FETCHED:
+        data = get_movie_metadata(movie_name)
+    
+    # 检查API返回的数据是否包含海报信息
+    if data:
+        poster_url = data.get("Poster")  # 获取海报URL
+        imdb_url = get_imdb_url(data)  # 获取IMDb URL
+        print("成功获取海报和IMDb URL！")
+        return poster_url or "N/A", imdb_url
+    else:
         return "N/A", "无法找到电影网址，请重试"
 
-def show_movie_poster(poster_url):
-    """显示电影海报"""
-    if poster_url == "N/A":
-        return None
-    try:
-        # 请求海报图像
-        response = requests.get(poster_url)
+class SingleFlight:
+    """合并相同键的并发调用：同一时刻只有一个调用真正执行，其余调用等待并共享其结果或异常"""
+    
+    def __init__(self, name):
+        """
+        参数:
+            name: 服务名称，用于日志和统计
+        """
+        self.name = name
+        self._calls = {}  # 键 -> 正在进行的调用的Future
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "executed": 0, "coalesced": 0, "errors": 0, "timeouts": 0}
+    
+    def acquire(self, key):
+        """
+        登记一次调用
         
-        # 检查请求是否成功
-        if response.status_code == 200:
-            img = Image.open(BytesIO(response.content))
-            img.save("poster.jpg")  # 保存图像
-            return img
+        返回:
+            tuple: (Future, 是否由本次调用执行)；不执行时等待Future即可得到结果
+        """
+        with self._lock:
+            self.stats["calls"] += 1
+            future = self._calls.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            self.stats["executed"] += 1
+            return future, True
+    
+    def release(self, key, future, result=None, error=None):
+        """执行者完成调用后公布结果或异常，并唤醒等待者"""
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+            if error is not None:
+                self.stats["errors"] += 1
+        if error is not None:
+            future.set_exception(error)
         else:
-            print(f"无法下载图像，HTTP 状态码：{response.status_code}")
+            future.set_result(result)
+    
+    def do(self, key, fn, *args, deadline=None, fallback=None, **kwargs):
+        """
+        执行fn(*args, **kwargs)；相同键的调用正在进行时，等待并共享其结果或异常
+        
+        参数:
+            deadline: 本次调用的截止时间，等待其他调用的结果超时后不再等待
+            fallback: 等待超时时返回的降级结果
+        """
+        future, is_owner = self.acquire(key)
+        if not is_owner:
+            print(f"[{self.name}] 合并相同的并发请求: {str(key)[:60]}")
+            try:
+                return future.result(timeout=deadline.remaining() if deadline is not None else None)
+            except FuturesTimeoutError:
+                with self._lock:
+                    self.stats["timeouts"] += 1
+                print(f"[{self.name}] 等待相同的请求超出请求时间预算: {str(key)[:60]}")
+                return fallback
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.release(key, future, error=e)
+            raise
+        self.release(key, future, result=result)
+        return result
+
+# 各外部服务的请求合并器
+tavily_flight = SingleFlight("tavily")
+omdb_flight = SingleFlight("omdb")
+llm_flight = SingleFlight("llm")
+image_flight = SingleFlight("modelscope_image")
+
+def get_singleflight_stats():
+    """返回各外部服务的请求合并统计"""
+    return {flight.name: dict(flight.stats) for flight in (tavily_flight, omdb_flight, llm_flight, image_flight)}
+
+class LRUCache:
+    """线程安全的内存LRU缓存，可选过期时间"""
+    
+    def __init__(self, max_items=128, ttl_seconds=None):
+        """
+        参数:
+            max_items: 最多保留的条目数
+            ttl_seconds: 条目过期时间(秒)，None表示不过期
+        """
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        """读取条目，命中时将其移到最近使用的位置"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at is not None and time.time() > expires_at:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        """写入条目，超出容量时淘汰最久未使用的条目"""
+        expires_at = time.time() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        """删除条目并返回其值"""
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[0] if item else default
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+class PosterCache:
+    """海报图片缓存：磁盘上按键的哈希保存原始图片字节（容量上限+LRU淘汰），内存中保存解码后的图片"""
+    
+    def __init__(self, cache_dir, max_bytes, memory_items):
+        """
+        参数:
+            cache_dir: 磁盘缓存目录
+            max_bytes: 磁盘缓存容量上限(字节)
+            memory_items: 内存中保留的已解码图片数量
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory = LRUCache(max_items=memory_items)
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+    
+    def _get_path(self, key):
+        """按键的SHA-256哈希获取缓存文件路径"""
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest())
+    
+    @staticmethod
+    def _decode(content):
+        """解码图片字节，并立即加载像素数据以便多线程共享"""
+        img = Image.open(BytesIO(content))
+        img.load()
+        return img
+    
+    def get(self, key):
+        """获取已解码的图片，未命中返回None"""
+        img = self.memory.get(key)
+        if img is not None:
+            return img
+        
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            os.utime(path)  # 更新修改时间，作为LRU淘汰依据
+        except OSError:
             return None
-    except requests.exceptions.ConnectionError:
-        print("网络连接不可达，无法下载图像。")
-        return None
-    except Exception as e:
-        print(f"下载或展示图像时发生错误: {e}")
+        
+        try:
+            img = self._decode(content)
+        except Exception as e:
+            print(f"[海报缓存] 缓存文件损坏，已删除: {e}")
+            self.delete(key)
+            return None
+        
+        self.memory.set(key, img)
+        return img
+    
+    def put(self, key, content):
+        """保存原始图片字节并返回解码后的图片，解码失败时抛出异常且不写入缓存"""
+        img = self._decode(content)
+        self.memory.set(key, img)
+        
+        path = self._get_path(key)
+        try:
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            with self._lock:
+                old_size = os.path.getsize(path) if os.path.exists(path) else 0
+                os.replace(tmp_path, path)
+                self._total_bytes += len(content) - old_size
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+        except OSError as e:
+            print(f"[海报缓存] 保存缓存失败: {e}")
+        return img
+    
+    def _evict(self):
+        """按最近访问时间淘汰磁盘缓存，直到低于容量上限（调用方需持有锁）"""
+        entries = [entry for entry in os.scandir(self.cache_dir)
+                   if entry.is_file() and not entry.name.endswith('.tmp')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self._total_bytes = sum(entry.stat().st_size for entry in entries)
+        
+        removed = 0
+        for entry in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._total_bytes -= size
+                removed += 1
+            except OSError:
+                pass
+        print(f"[海报缓存] 超出容量上限，已淘汰 {removed} 个文件")
+    
+    def delete(self, key):
+        """删除指定条目（内存和磁盘）"""
+        self.memory.pop(key)
+        path = self._get_path(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._total_bytes -= size
+                return True
+            except OSError:
+                return False
+    
+    def clear(self):
+        """清空全部缓存，返回删除的文件数"""
+        self.memory.clear()
+        removed = 0
+        with self._lock:
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file():
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    except OSError:
+                        pass
+            self._total_bytes = 0
+        return removed
+
+# 创建全局海报缓存实例，按海报URL缓存
+poster_cache = PosterCache(POSTER_CACHE_DIR, int(POSTER_CACHE_MAX_MB * 1024 * 1024), POSTER_MEMORY_CACHE_ITEMS)
+
+# 创建全局AI海报缓存实例，按电影身份（规范化标题+年份）缓存
+ai_poster_cache = PosterCache(AI_POSTER_CACHE_DIR, int(AI_POSTER_CACHE_MAX_MB * 1024 * 1024), POSTER_MEMORY_CACHE_ITEMS)
+
+def get_movie_identity(movie_name, year=None):
+    """获取电影的稳定身份标识：规范化标题+年份"""
+    title_key = normalize_title_key(get_lookup_title(movie_name))
+    year_match = re.search(r'\d{4}', str(year or ""))
+    return f"{title_key}|{year_match.group(0) if year_match else ''}"
+
+def get_ai_poster(movie_name, year, prompt, deadline=None):
+    """
+    获取AI生成的海报，优先使用缓存
+    
+    参数:
+        movie_name: 电影标题
+        year: 上映年份
+        prompt: 生成海报的提示词（不参与缓存键，每次描述不同也能命中）
+        deadline: 请求的截止时间，剩余时间不足以生成海报时跳过
+    
+    返回:
+        Image: 生成的海报图片；跳过生成时返回None
+    """
+    with span("ai_poster") as stage:
+        identity = get_movie_identity(movie_name, year)
+        img = ai_poster_cache.get(identity)
+        if img is not None:
+            print(f"[AI海报] 使用缓存海报: {identity}")
+            stage["outcome"] = "cache_hit"
+            return img
+    
+        # 第一级降级：剩余时间不够生成海报时不再生成
+        if deadline is not None and not deadline.allows(DEADLINE_AI_POSTER_MIN_SECONDS):
+            print(f"[AI海报] 剩余时间不足，跳过生成: {identity}")
+            stage["outcome"] = "skipped"
+            return None
+    
+        # 相同电影正在生成时等待其结果，共享同一次生成
+        return image_flight.do(identity, _generate_ai_poster, identity, prompt, deadline, deadline=deadline)
+
+def _generate_ai_poster(identity, prompt, deadline=None):
+    """生成AI海报并写入缓存"""
+    # 获得生成权后再检查一次缓存，避免与刚结束的生成重复
+    img = ai_poster_cache.get(identity)
+    if img is None:
+        print(f"[AI海报] 正在生成海报: {identity}")
+        img = ai_poster_cache.put(identity, generate_image_bytes(prompt, deadline))
+    return img
+
+def purge_ai_posters(movie_name=None, year=None):
+    """
+    清除AI海报缓存
+    
+    参数:
+        movie_name: 电影标题，为None时清空全部AI海报
+        year: 上映年份，需与推荐时的年份一致
+    
+    返回:
+        int: 删除的海报数量
+    """
+    if movie_name is None:
+        removed = ai_poster_cache.clear()
+    else:
+        removed = 1 if ai_poster_cache.delete(get_movie_identity(movie_name, year)) else 0
+    print(f"[AI海报] 已清除 {removed} 张缓存海报")
+    return removed
+
+def show_movie_poster(poster_url, deadline=None):
+    """显示电影海报，优先使用海报缓存；传入请求截止时间且剩余时间不足时不再下载"""
+    if poster_url == "N/A":
         return None
+    
+    with span("poster") as stage:
+        img = poster_cache.get(poster_url)
+        if img is not None:
+            stage["outcome"] = "cache_hit"
+            return img
+    
+        # 第二级降级：剩余时间不够下载海报时只显示文字信息
+        if deadline is not None and not deadline.allows(DEADLINE_POSTER_MIN_SECONDS):
+            print(f"[海报] 剩余时间不足，跳过下载: {poster_url}")
+            stage["outcome"] = "skipped"
+            return None
+    
+        try:
+            # 请求海报图像
+            response = http_get(poster_url, timeout=get_request_timeout(deadline))
+        
+            # 检查请求是否成功
+            if response.status_code == 200:
+                return poster_cache.put(poster_url, response.content)
+            else:
+                print(f"无法下载图像，HTTP 状态码：{response.status_code}")
+                stage["outcome"] = "error"
+                return None
+        except requests.exceptions.ConnectionError:
+            print("网络连接不可达，无法下载图像。")
+            stage["outcome"] = "error"
+            return None
+        except Exception as e:
+            print(f"下载或展示图像时发生错误: {e}")
+            stage["outcome"] = "error"
+            return None
 
 # ----- 新增Tavily搜索功能 -----
 
+class SQLiteCache:
+    """基于单个SQLite文件(WAL模式)的键值缓存，支持批量过期清理、容量上限LRU淘汰和可选压缩"""
+    
+    # 每写入多少次执行一次过期清理
+    SWEEP_INTERVAL = 100
+    
+    def __init__(self, db_path, max_bytes, compress=False):
+        """
+        参数:
+            db_path: 数据库文件路径
+            max_bytes: 缓存内容总大小上限(字节)
+            compress: 是否使用zlib压缩缓存内容
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.is_new = not os.path.exists(db_path)
+        self._lock = threading.Lock()
+        self._writes = 0
+        
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    compressed INTEGER NOT NULL DEFAULT 0,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON cache(expires_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache(last_access)")
+    
+    def get(self, key):
+        """读取未过期的条目，未命中或已过期返回None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, compressed, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, compressed, expires_at = row
+            if expires_at <= now:
+                print(f"[缓存] 缓存已过期: {key}")
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+        
+        if compressed:
+            value = zlib.decompress(value)
+        return json.loads(value.decode('utf-8'))
+    
+    def set(self, key, data, ttl_seconds, created_at=None):
+        """写入条目，created_at用于迁移时保留原始写入时间"""
+        now = time.time()
+        created_at = created_at or now
+        value = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        if self.compress:
+            value = zlib.compress(value)
+        
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, compressed, size, created_at, expires_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, value, int(self.compress), len(value), created_at, created_at + ttl_seconds, now)
+                )
+            self._writes += 1
+            if self._writes % self.SWEEP_INTERVAL == 0:
+                self._purge_expired()
+            self._enforce_size_limit()
+    
+    def delete(self, key):
+        """删除指定条目"""
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount > 0
+    
+    def purge_expired(self):
+        """批量删除全部过期条目，返回删除数量"""
+        with self._lock:
+            return self._purge_expired()
+    
+    def _purge_expired(self):
+        """批量删除过期条目（调用方需持有锁）"""
+        with self._conn:
+            removed = self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),)).rowcount
+        if removed:
+            print(f"[缓存] 已清理 {removed} 条过期缓存")
+        return removed
+    
+    def _enforce_size_limit(self):
+        """超出容量上限时按最近访问时间淘汰条目（调用方需持有锁）"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        removed = 0
+        with self._conn:
+            rows = self._conn.execute("SELECT key, size FROM cache ORDER BY last_access").fetchall()
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                total -= size
+                removed += 1
+        print(f"[缓存] 超出容量上限，已淘汰 {removed} 条缓存")
+    
+    def stats(self):
+        """返回缓存条目数和总大小"""
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return {"entries": count, "bytes": total}
+
+def migrate_tavily_json_cache(cache, json_dir=CACHE_DIR, delete=False):
+    """
+    将旧版每个查询一个JSON文件的Tavily缓存导入SQLite缓存
+    
+    参数:
+        cache: 目标SQLiteCache实例
+        json_dir: 旧版缓存目录
+        delete: 导入成功后是否删除旧的JSON文件
+    
+    返回:
+        int: 导入的条目数（已过期的条目会被跳过）
+    """
+    imported = 0
+    for file_name in os.listdir(json_dir):
+        if not file_name.endswith('.json'):
+            continue
+        path = os.path.join(json_dir, file_name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                cache_data = json.load(f)
+            created_at = datetime.fromisoformat(cache_data.get('timestamp', '2000-01-01T00:00:00')).timestamp()
+            cache_hours = TAVILY_CACHE_DURATION.get(cache_data.get('movie_type', 'recent'), 24)
+            if created_at + cache_hours * 3600 > time.time():
+                cache.set(file_name[:-len('.json')], cache_data.get('data'), cache_hours * 3600, created_at=created_at)
+                imported += 1
+            if delete:
+                os.remove(path)
+        except Exception as e:
+            print(f"[Tavily] 迁移缓存文件失败 {file_name}: {str(e)}")
+    
+    print(f"[Tavily] 已从旧版JSON缓存导入 {imported} 条记录")
+    return imported
+
+_tavily_cache = None
+_tavily_cache_lock = threading.Lock()
+
+def get_tavily_cache():
+    """获取全局Tavily缓存，首次创建数据库时自动导入旧版JSON缓存"""
+    global _tavily_cache
+    if _tavily_cache is None:
+        with _tavily_cache_lock:
+            if _tavily_cache is None:
+                cache = SQLiteCache(TAVILY_CACHE_DB, int(TAVILY_CACHE_MAX_MB * 1024 * 1024), TAVILY_CACHE_COMPRESS)
+                if cache.is_new:
+                    migrate_tavily_json_cache(cache)
+                _tavily_cache = cache
+    return _tavily_cache
+
 class MovieSearchEngine:
     """电影搜索引擎类，使用Tavily API"""
     
@@ -252,7 +1394,7 @@ class MovieSearchEngine:
         参数:
             api_key: Tavily API密钥。如果为None，则尝试从环境变量获取
         """
-        self.api_key = os.environ.get("TAVILY_API_KEY")
+        self.api_key = api_key or os.environ.get("TAVILY_API_KEY")
         if not self.api_key:
             raise ValueError("必须提供Tavily API密钥，通过参数或TAVILY_API_KEY环境变量")
         
@@ -260,50 +1402,74 @@ class MovieSearchEngine:
         
         # 缓存配置
         self.use_cache = True  # 是否使用缓存
-        self.cache_duration = {
-            "recent": 24,    # 最新电影信息缓存24小时
-            "classic": 168   # 经典电影信息缓存7天(168小时)
-        }
+        self.cache_duration = dict(TAVILY_CACHE_DURATION)  # 不同类型电影信息的缓存时长(小时)
+        self.cache = get_tavily_cache()
+        # 内存热缓存，位于磁盘缓存之前，进程内重复查询无需访问文件系统
+        self.memory_cache = LRUCache(max_items=TAVILY_MEMORY_CACHE_ITEMS, ttl_seconds=TAVILY_MEMORY_CACHE_TTL)
     
-    def search(self, query, max_results=5):
+    def search(self, query, max_results=5, deadline=None):
         """
         使用Tavily API进行通用搜索
         
         参数:
             query: 用户输入的查询字符串
             max_results: 最大结果数
+            deadline: 请求的截止时间，排队和请求都不超过其剩余时间
         
         返回:
             dict: 包含搜索结果的信息
         """
-        # 尝试从缓存获取
-        if self.use_cache:
-            cache_key = self._generate_cache_key(query)
-            cached_result = self._get_from_cache(cache_key)
-            if cached_result:
-                print(f"[Tavily] 使用缓存结果: '{query}'")
-                return cached_result
+        with span("tavily") as stage:
+            # 尝试从缓存获取，先查内存热缓存，再查磁盘缓存
+            if self.use_cache:
+                cache_key = self._generate_cache_key(query)
+                cached_result = self.memory_cache.get(cache_key)
+                if cached_result:
+                    print(f"[Tavily] 使用内存缓存结果: '{query}'")
+                    stage["outcome"] = "memory_hit"
+                    return cached_result
+            
+                cached_result = self._get_from_cache(cache_key)
+                if cached_result:
+                    print(f"[Tavily] 使用缓存结果: '{query}'")
+                    self.memory_cache.set(cache_key, cached_result)
+                    stage["outcome"] = "cache_hit"
+                    return cached_result
         
-        try:
-            print(f"[Tavily] 正在搜索: '{query}'")
+            try:
+                # 相同查询的并发搜索合并为一次请求
+                flight_key = f"{self._generate_cache_key(query)}|{max_results}"
+                stage["outcome"] = "miss"
+                return tavily_flight.do(flight_key, self._fetch, query, max_results, deadline, deadline=deadline,
+                                        fallback={"error": True, "message": "搜索失败: 超出请求时间预算"})
+            except Exception as e:
+                print(f"[错误] Tavily搜索失败: {str(e)}")
+                stage["outcome"] = "error"
+                return {
+                    "error": True,
+                    "message": f"搜索失败: {str(e)}"
+                }
+
+    def _fetch(self, query, max_results, deadline=None):
+        """调用Tavily API搜索并写入缓存"""
+        print(f"[Tavily] 正在搜索: '{query}'")
+        options = {"timeout": deadline.limit(HTTP_READ_TIMEOUT)} if deadline is not None else {}
+        with get_limiter("tavily").limit(deadline=deadline):
             response = self.client.search(
                 query=query,
                 search_type="search",
-                max_results=max_results
+                max_results=max_results,
+                **options
             )
-            formatted_result = self.format_results(response)
-            
-            # 保存到缓存
-            if self.use_cache:
-                self._save_to_cache(cache_key, formatted_result)
-                
-            return formatted_result
-        except Exception as e:
-            print(f"[错误] Tavily搜索失败: {str(e)}")
-            return {
-                "error": True,
-                "message": f"搜索失败: {str(e)}"
-            }
+        formatted_result = self.format_results(response)
+        
+        # 保存到缓存
+        if self.use_cache:
+            cache_key = self._generate_cache_key(query)
+            self.memory_cache.set(cache_key, formatted_result)
+            self._save_to_cache(cache_key, formatted_result)
+        
+        return formatted_result
 
     def format_results(self, search_result):
         """
@@ -337,80 +1503,123 @@ class MovieSearchEngine:
         hash_obj = hashlib.md5(query.encode('utf-8'))
         return hash_obj.hexdigest()
     
-    def _get_cache_path(self, cache_key):
-        """获取缓存文件路径"""
-        return os.path.join(CACHE_DIR, f"{cache_key}.json")
-    
     def _get_from_cache(self, cache_key):
         """从缓存获取结果"""
-        cache_path = self._get_cache_path(cache_key)
-        
-        # 如果缓存文件不存在，返回None
-        if not os.path.exists(cache_path):
-            return None
-            
-        # 读取缓存文件
         try:
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                cache_data = json.load(f)
-                
-            # 检查缓存是否过期
-            cache_time = datetime.fromisoformat(cache_data.get('timestamp', '2000-01-01T00:00:00'))
-            movie_type = cache_data.get('movie_type', 'recent')  # 默认为最新电影
-            cache_hours = self.cache_duration.get(movie_type, 24)  # 默认24小时
-            
-            # 如果缓存已过期，返回None
-            if datetime.now() - cache_time > timedelta(hours=cache_hours):
-                print(f"[Tavily] 缓存已过期: {cache_key}")
-                return None
-                
-            return cache_data.get('data')
+            return self.cache.get(cache_key)
         except Exception as e:
             print(f"[Tavily] 读取缓存失败: {str(e)}")
             return None
     
     def _save_to_cache(self, cache_key, data, movie_type='recent'):
         """保存结果到缓存"""
-        cache_path = self._get_cache_path(cache_key)
-        
         try:
-            # 创建缓存数据结构
-            cache_data = {
-                'timestamp': datetime.now().isoformat(),
-                'movie_type': movie_type,  # 电影类型决定缓存时长
-                'data': data
-            }
-            
-            # 写入缓存文件
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False, indent=2)
-                
+            # 电影类型决定缓存时长
+            cache_hours = self.cache_duration.get(movie_type, 24)
+            self.cache.set(cache_key, data, cache_hours * 3600)
             print(f"[Tavily] 已保存到缓存: {cache_key}")
         except Exception as e:
             print(f"[Tavily] 保存缓存失败: {str(e)}")
 
-# 创建全局搜索引擎实例
+def _get_char_bigrams(text):
+    """获取文本的字符二元组集合（忽略大小写和空白），用于计算相似度"""
+    text = "".join(text.lower().split())
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _clean_snippet(text):
+    """清理搜索片段中的链接、省略号和多余空白等无用内容"""
+    text = re.sub(r'https?://\S+', '', text)
+    text = re.sub(r'[#*>|]+|\.{3,}|…+', ' ', text)
+    return " ".join(text.split())
+
+def pack_search_context(search_result, query, char_budget=None):
+    """
+    将Tavily搜索结果整理为紧凑的提示词上下文
+    
+    参数:
+        search_result: tavily_search的返回结果
+        query: 搜索查询，用于按相关性排序
+        char_budget: 上下文总字符数上限，默认使用TAVILY_CONTEXT_CHAR_BUDGET
+    
+    返回:
+        str: 去重、按相关性排序并截断后的片段列表，只保留标题和内容
+    """
+    char_budget = char_budget or TAVILY_CONTEXT_CHAR_BUDGET
+    if not search_result or search_result.get("error"):
+        return "无"
+    
+    query_bigrams = _get_char_bigrams(query)
+    candidates = []
+    for result in search_result.get("results", []):
+        title = _clean_snippet(result.get("title", ""))
+        content = _clean_snippet(result.get("content", ""))
+        if not content or content == "无内容":
+            continue
+        bigrams = _get_char_bigrams(title + content)
+        relevance = len(query_bigrams & bigrams) / len(query_bigrams) if query_bigrams else 0
+        candidates.append((relevance, title, content, bigrams))
+    
+    # 按与查询的相关性排序，相关性相同时保持搜索引擎的原有顺序
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    
+    lines = []
+    selected_bigrams = []
+    used_chars = 0
+    for relevance, title, content, bigrams in candidates:
+        # 跳过与已选片段高度重合的片段
+        if any(len(bigrams & other) / max(1, min(len(bigrams), len(other))) > SNIPPET_DUPLICATE_THRESHOLD
+               for other in selected_bigrams):
+            continue
+        
+        if len(content) > TAVILY_SNIPPET_MAX_CHARS:
+            content = content[:TAVILY_SNIPPET_MAX_CHARS] + "…"
+        line = f"- {title}：{content}" if title else f"- {content}"
+        remaining = char_budget - used_chars
+        if len(line) > remaining:
+            # 剩余预算足够时截断放入，否则停止
+            if remaining < 50:
+                break
+            line = line[:remaining - 1] + "…"
+        lines.append(line)
+        selected_bigrams.append(bigrams)
+        used_chars += len(line) + 1
+    
+    return "\n".join(lines) if lines else "无"
+
+# 全局搜索引擎实例，首次使用时创建，整个进程共享
+_search_engine = None
+_search_engine_lock = threading.Lock()
+
 def get_movie_search_engine():
     """获取或创建电影搜索引擎实例"""
-    try:
-        tavily_api_key = os.environ.get("TAVILY_API_KEY")
-        if not tavily_api_key:
-            print("[警告] 未找到TAVILY_API_KEY环境变量，搜索功能可能不可用")
-            return None
+    global _search_engine
+    if _search_engine is not None:
+        return _search_engine
+    
+    with _search_engine_lock:
+        if _search_engine is not None:
+            return _search_engine
+        try:
+            tavily_api_key = os.environ.get("TAVILY_API_KEY")
+            if not tavily_api_key:
+                print("[警告] 未找到TAVILY_API_KEY环境变量，搜索功能可能不可用")
+                return None
             
-        return MovieSearchEngine(api_key=tavily_api_key)
-    except Exception as e:
-        print(f"[错误] 创建电影搜索引擎失败: {str(e)}")
-        return None
+            _search_engine = MovieSearchEngine(api_key=tavily_api_key)
+            return _search_engine
+        except Exception as e:
+            print(f"[错误] 创建电影搜索引擎失败: {str(e)}")
+            return None
 
 # 简便的搜索方法
-def tavily_search(query, max_results=5):
+def tavily_search(query, max_results=5, deadline=None):
     """
     使用Tavily搜索电影相关信息
     
     参数:
         query: 搜索查询
         max_results: 最大结果数
+        deadline: 请求的截止时间
         
     返回:
         dict: 包含搜索结果的信息
@@ -422,4 +1631,29 @@ def tavily_search(query, max_results=5):
             "message": "搜索引擎初始化失败，请检查TAVILY_API_KEY环境变量"
         }
         
-    return engine.search(query, max_results=max_results) 
\ No newline at end of file
+    return engine.search(query, max_results=max_results, deadline=deadline)
+
+# 缓存管理命令行入口
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="电影推荐官缓存管理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    purge_parser = subparsers.add_parser("purge-ai-posters", help="清除AI生成的海报缓存")
+    purge_parser.add_argument("--title", help="电影标题，如\"盗梦空间(Inception)\"；不指定则清空全部")
+    purge_parser.add_argument("--year", help="上映年份")
+    
+    migrate_parser = subparsers.add_parser("migrate-tavily-cache", help="将旧版JSON格式的Tavily缓存导入SQLite")
+    migrate_parser.add_argument("--delete", action="store_true", help="导入后删除旧的JSON文件")
+    
+    subparsers.add_parser("sweep-tavily-cache", help="清理过期的Tavily缓存")
+    
+    args = parser.parse_args()
+    if args.command == "purge-ai-posters":
+        purge_ai_posters(args.title, args.year)
+    elif args.command == "migrate-tavily-cache":
+        migrate_tavily_json_cache(get_tavily_cache(), delete=args.delete)
+    elif args.command == "sweep-tavily-cache":
+        get_tavily_cache().purge_expired()
+        print(f"[Tavily] 当前缓存: {get_tavily_cache().stats()}")
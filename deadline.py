@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+# 加载.env文件中的环境变量
+load_dotenv()
+
+# 每次推荐请求的总时间预算(秒)，超出后不再等待未完成的阶段，直接返回已有的结果
+REQUEST_SLO_SECONDS = float(os.getenv("REQUEST_SLO_SECONDS", "90"))
+
+# 逐级降级：剩余时间不足以下值时跳过对应阶段。随着剩余时间减少，依次放弃 1.AI海报 2.真实海报 3.搜索参考，
+# 因此三个阈值需保持 AI海报 > 真实海报 > 搜索参考
+DEADLINE_AI_POSTER_MIN_SECONDS = float(os.getenv("DEADLINE_AI_POSTER_MIN_SECONDS", "30"))   # 第一级：生成AI海报需要的剩余时间
+DEADLINE_POSTER_MIN_SECONDS = float(os.getenv("DEADLINE_POSTER_MIN_SECONDS", "10"))         # 第二级：下载真实海报需要的剩余时间
+DEADLINE_SEARCH_MIN_SECONDS = float(os.getenv("DEADLINE_SEARCH_MIN_SECONDS", "5"))          # 第三级：调用Tavily需要的剩余时间
+
+class DeadlineExceeded(Exception):
+    """请求的时间预算已用完"""
+
+class Deadline:
+    """请求的截止时间：随请求传给模型、Tavily、OMDb、海报下载和AI生成，各阶段按剩余时间决定超时和是否降级"""
+
+    def __init__(self, seconds=REQUEST_SLO_SECONDS, parent=None):
+        """
+        参数:
+            seconds: 从现在起的时间预算(秒)
+            parent: 上级截止时间，子截止时间不会晚于上级，上级取消时子截止时间也随之取消
+        """
+        self.expires_at = time.monotonic() + seconds
+        if parent is not None:
+            self.expires_at = min(self.expires_at, parent.expires_at)
+        self.parent = parent
+        self._cancelled = threading.Event()
+
+    def child(self):
+        """创建可单独取消的子截止时间，如对冲请求中的每个模型"""
+        return Deadline(self.remaining(), parent=self)
+
+    def cancel(self):
+        """取消：之后remaining()返回0，正在进行的阶段会尽快停止"""
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set() or (self.parent is not None and self.parent.cancelled())
+
+    def remaining(self):
+        """剩余时间(秒)，已取消或已超时时为0"""
+        if self.cancelled():
+            return 0.0
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, seconds):
+        """剩余时间是否还够一个至少需要seconds秒的阶段"""
+        return self.remaining() >= seconds
+
+    def limit(self, timeout):
+        """将阶段自身的超时限制在剩余时间内"""
+        return max(0.001, min(timeout, self.remaining()))
+
+    def check(self, stage=""):
+        """时间预算已用完时抛出DeadlineExceeded"""
+        if self.expired():
+            raise DeadlineExceeded(f"{stage}超出请求时间预算" if stage else "超出请求时间预算")
@@ -0,0 +1,199 @@
+import atexit
+import json
+import math
+import os
+import re
+import threading
+import time
+
+# 遗忘检索本地全文索引配置
+FUZZY_INDEX_DIR = "fuzzy_index"
+FUZZY_INDEX_PATH = os.path.join(FUZZY_INDEX_DIR, "documents.json")
+FUZZY_INDEX_MAX_TEXTS = 20        # 每部电影最多保留的文本片段数
+FUZZY_INDEX_MAX_TEXT_CHARS = 500  # 每个文本片段最多保留的字符数
+FUZZY_INDEX_FLUSH_SECONDS = float(os.getenv("FUZZY_INDEX_FLUSH_SECONDS", "30"))  # 新收录的文本最多延迟多久写入磁盘(秒)
+
+# BM25参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 中文连续字符切成二元组，英文和数字按单词切分
+CJK_RUN_PATTERN = re.compile(r'[一-鿿]+|[a-z0-9]+')
+
+def tokenize(text):
+    """将文本切分为词项：中文按字二元组（单字时保留单字），英文和数字按单词"""
+    tokens = []
+    for run in CJK_RUN_PATTERN.findall(str(text or "").lower()):
+        if not '一' <= run[0] <= '鿿':
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class FuzzyIndex:
+    """BM25倒排索引：收录过去模型回答中的剧情描述、推荐理由和Tavily片段，按电影标题聚合"""
+
+    def __init__(self, path=FUZZY_INDEX_PATH, flush_seconds=FUZZY_INDEX_FLUSH_SECONDS):
+        """
+        参数:
+            path: 文档文件路径，倒排索引在加载时重建
+            flush_seconds: 收录文本后最多延迟多久写入磁盘，期间的多次收录合并为一次写入
+        """
+        self.path = path
+        self._documents = {}   # 标题 -> {"title", "year", "genre", "description", "texts", "updated_at"}
+        self._postings = {}    # 词项 -> {标题: 词频}
+        self._lengths = {}     # 标题 -> 文档词项数
+        self._terms = {}       # 标题 -> 文档包含的词项集合，用于更新时删除旧的倒排记录
+        self.flush_seconds = flush_seconds
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()   # 定时写入和退出时写入不能同时写同一个文件
+        self._dirty = False
+        self._flush_timer = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._load()
+        atexit.register(self.flush)
+
+    def _load(self):
+        """从磁盘加载文档并重建倒排索引"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for document in json.load(f):
+                    self._documents[document["title"]] = document
+                    self._index(document["title"])
+            print(f"[遗忘检索索引] 已加载 {len(self._documents)} 部电影")
+        except Exception as e:
+            print(f"[遗忘检索索引] 加载索引失败: {e}")
+
+    def _mark_dirty(self):
+        """标记有未保存的修改，flush_seconds秒后合并写入磁盘（调用方需持有锁）"""
+        self._dirty = True
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_seconds, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """将未保存的修改写入磁盘，由定时器和退出时调用"""
+        with self._save_lock:
+            with self._lock:
+                self._flush_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                documents = [dict(document) for document in self._documents.values()]
+            self._save(documents)
+
+    def _save(self, documents):
+        """将文档写入磁盘"""
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(documents, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[遗忘检索索引] 保存索引失败: {e}")
+
+    def _index(self, title):
+        """重建单部电影的倒排记录（调用方需持有锁）"""
+        for token in self._terms.get(title, ()):
+            self._postings[token].pop(title, None)
+        document = self._documents[title]
+        tokens = tokenize(" ".join([title] + document["texts"]))
+        self._lengths[title] = len(tokens)
+        self._terms[title] = set(tokens)
+        for token in tokens:
+            postings = self._postings.setdefault(token, {})
+            postings[title] = postings.get(title, 0) + 1
+
+    def add_documents(self, items):
+        """
+        批量收录文本片段
+
+        参数:
+            items: 字典列表，每项包含title、text，可选year、genre、description
+        """
+        changed = False
+        with self._lock:
+            for item in items:
+                title = (item.get("title") or "").strip()
+                text = (item.get("text") or "").strip()[:FUZZY_INDEX_MAX_TEXT_CHARS]
+                if not title or not text:
+                    continue
+                document = self._documents.setdefault(title, {
+                    "title": title, "year": "", "genre": "", "description": "", "texts": [], "updated_at": 0
+                })
+                for field in ("year", "genre", "description"):
+                    if item.get(field) and not document[field]:
+                        document[field] = item[field]
+                if text in document["texts"]:
+                    continue
+                document["texts"] = (document["texts"] + [text])[-FUZZY_INDEX_MAX_TEXTS:]
+                document["updated_at"] = time.time()
+                self._index(title)
+                changed = True
+            if changed:
+                self._mark_dirty()
+
+    def search(self, query, limit=5):
+        """
+        按BM25检索与描述最相关的电影
+
+        参数:
+            query: 用户的描述
+            limit: 最多返回数量
+
+        返回:
+            list: 字典列表，包含title、year、genre、description、score和coverage（查询词项被命中的比例）
+        """
+        query_tokens = set(tokenize(query))
+        if not query_tokens:
+            return []
+        with self._lock:
+            total = len(self._documents)
+            if not total:
+                return []
+            avg_length = sum(self._lengths.values()) / total
+            scores = {}
+            matched = {}
+            for token in query_tokens:
+                postings = self._postings.get(token)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for title, tf in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[title] / avg_length)
+                    scores[title] = scores.get(title, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+                    matched[title] = matched.get(title, 0) + 1
+
+            results = []
+            for title in sorted(scores, key=scores.get, reverse=True)[:limit]:
+                document = self._documents[title]
+                results.append({
+                    "title": title,
+                    "year": document["year"],
+                    "genre": document["genre"],
+                    "description": document["description"],
+                    "score": scores[title],
+                    "coverage": matched[title] / len(query_tokens)
+                })
+            return results
+
+    def __len__(self):
+        with self._lock:
+            return len(self._documents)
+
+# 创建全局遗忘检索索引实例
+fuzzy_index = FuzzyIndex()
+
+# 在命令行中检索：python fuzzy_index.py "一个人被困在火星上种土豆"
+if __name__ == "__main__":
+    import sys
+
+    print(f"[遗忘检索索引] 共 {len(fuzzy_index)} 部电影")
+    if len(sys.argv) > 1:
+        for result in fuzzy_index.search(sys.argv[1]):
+            print(f"  {result['title']} ({result['year']}) 得分 {result['score']:.2f} 覆盖率 {result['coverage']:.0%}")
@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+import numpy as np
+
+# 本地IMDb标题索引配置
+IMDB_INDEX_DIR = os.getenv("IMDB_INDEX_DIR", "imdb_index")
+IMDB_TITLE_TYPES = {"movie", "tvMovie"}   # 只收录电影和电视电影
+
+# 索引由以下等长数组组成，按(标题哈希, 投票数降序)排序，加载时以内存映射方式打开
+INDEX_ARRAYS = ("hashes", "tconsts", "years", "ratings", "votes")
+
+def normalize_imdb_title(title):
+    """规范化标题：去除重音、大小写、标点、空白和开头的冠词，使"The Dark Knight"和"dark knight"一致"""
+    title = unicodedata.normalize("NFKD", title or "")
+    title = "".join(char for char in title if not unicodedata.combining(char)).lower()
+    title = re.sub(r'^(the|a|an)\s+', '', title.strip())
+    title = title.replace("&", "and")
+    return re.sub(r'[\W_]+', '', title)
+
+def hash_title(title):
+    """将规范化后的标题哈希为64位整数"""
+    key = normalize_imdb_title(title)
+    if not key:
+        return None
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), "little")
+
+def _open_tsv(path):
+    """打开TSV文件，支持.gz压缩格式"""
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def build_imdb_index(basics_path, ratings_path, index_dir=IMDB_INDEX_DIR):
+    """
+    从IMDb公开数据集构建本地标题索引
+
+    参数:
+        basics_path: title.basics.tsv(.gz)路径
+        ratings_path: title.ratings.tsv(.gz)路径
+        index_dir: 索引输出目录
+
+    返回:
+        int: 索引条目数
+    """
+    start_time = time.time()
+    ratings = {}
+    with _open_tsv(ratings_path) as f:
+        next(f)  # 跳过表头
+        for line in f:
+            tconst, average_rating, num_votes = line.rstrip('\n').split('\t')
+            ratings[tconst] = (round(float(average_rating) * 10), int(num_votes))
+    print(f"[IMDb索引] 已读取 {len(ratings)} 条评分")
+
+    hashes, tconsts, years, scores, votes = [], [], [], [], []
+    with _open_tsv(basics_path) as f:
+        next(f)
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 6 or fields[1] not in IMDB_TITLE_TYPES or fields[4] == "1":
+                continue
+            tconst = fields[0]
+            rating, vote_count = ratings.get(tconst, (0, 0))
+            year = int(fields[5]) if fields[5].isdigit() else 0
+            # 主标题和原始标题都指向同一个tconst
+            for title_hash in {hash_title(fields[2]), hash_title(fields[3])} - {None}:
+                hashes.append(title_hash)
+                tconsts.append(int(tconst[2:]))
+                years.append(year)
+                scores.append(rating)
+                votes.append(vote_count)
+
+    arrays = {
+        "hashes": np.array(hashes, dtype=np.uint64),
+        "tconsts": np.array(tconsts, dtype=np.uint32),
+        "years": np.array(years, dtype=np.uint16),
+        "ratings": np.array(scores, dtype=np.uint8),      # 评分×10
+        "votes": np.array(votes, dtype=np.uint32)
+    }
+    order = np.lexsort((-arrays["votes"].astype(np.int64), arrays["hashes"]))
+
+    os.makedirs(index_dir, exist_ok=True)
+    for name in INDEX_ARRAYS:
+        tmp_path = os.path.join(index_dir, f"{name}.tmp.npy")
+        np.save(tmp_path, arrays[name][order])
+        os.replace(tmp_path, os.path.join(index_dir, f"{name}.npy"))
+    print(f"[IMDb索引] 已写入 {len(order)} 条索引，用时 {time.time() - start_time:.1f}秒")
+    return len(order)
+
+class IMDbIndex:
+    """内存映射的IMDb标题索引：规范化标题 -> tconst、年份、评分"""
+
+    def __init__(self, index_dir=IMDB_INDEX_DIR):
+        """
+        参数:
+            index_dir: build_imdb_index生成的索引目录
+        """
+        arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode='r') for name in INDEX_ARRAYS}
+        self.hashes = arrays["hashes"]
+        self.tconsts = arrays["tconsts"]
+        self.years = arrays["years"]
+        self.ratings = arrays["ratings"]
+        self.votes = arrays["votes"]
+
+    def lookup(self, title, year=None):
+        """
+        按标题（和年份）查找IMDb条目
+
+        参数:
+            title: 电影标题（英文或原始标题）
+            year: 上映年份，可为None或"2010年"等字符串；同名电影优先选择年份最接近的
+
+        返回:
+            dict: 包含imdb_id、year、rating、votes；未找到时返回None
+        """
+        title_hash = hash_title(title)
+        if title_hash is None:
+            return None
+        key = np.uint64(title_hash)
+        lo = int(np.searchsorted(self.hashes, key, side='left'))
+        hi = int(np.searchsorted(self.hashes, key, side='right'))
+        if lo == hi:
+            return None
+
+        # 同名条目已按投票数降序排列；给出年份时选择年份相差不超过1年的第一个
+        best = lo
+        match = re.search(r'\d{4}', str(year or ""))
+        if match:
+            target = int(match.group(0))
+            close = [i for i in range(lo, hi) if abs(int(self.years[i]) - target) <= 1]
+            if not close:
+                return None
+            best = close[0]
+
+        return {
+            "imdb_id": f"tt{int(self.tconsts[best]):07d}",
+            "year": int(self.years[best]) or None,
+            "rating": int(self.ratings[best]) / 10 if self.ratings[best] else None,
+            "votes": int(self.votes[best])
+        }
+
+    def __len__(self):
+        return len(self.hashes)
+
+# 全局索引实例：首次使用时加载，索引文件不存在时为None
+_imdb_index = None
+_imdb_index_loaded = False
+_imdb_index_lock = threading.Lock()
+
+def get_imdb_index():
+    """获取全局IMDb索引，没有构建过索引时返回None"""
+    global _imdb_index, _imdb_index_loaded
+    if not _imdb_index_loaded:
+        with _imdb_index_lock:
+            if not _imdb_index_loaded:
+                if all(os.path.exists(os.path.join(IMDB_INDEX_DIR, f"{name}.npy")) for name in INDEX_ARRAYS):
+                    try:
+                        _imdb_index = IMDbIndex()
+                        print(f"[IMDb索引] 已加载 {len(_imdb_index)} 条索引")
+                    except Exception as e:
+                        print(f"[IMDb索引] 加载索引失败: {e}")
+                _imdb_index_loaded = True
+    return _imdb_index
+
+# 构建索引：python imdb_index.py build title.basics.tsv.gz title.ratings.tsv.gz
+# 查询标题：python imdb_index.py lookup "Inception" [2010]
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地IMDb标题索引")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="从IMDb数据集构建索引")
+    build_parser.add_argument("basics", help="title.basics.tsv(.gz)路径")
+    build_parser.add_argument("ratings", help="title.ratings.tsv(.gz)路径")
+
+    lookup_parser = subparsers.add_parser("lookup", help="按标题查询")
+    lookup_parser.add_argument("title", help="电影标题")
+    lookup_parser.add_argument("year", nargs="?", help="上映年份")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build_imdb_index(args.basics, args.ratings)
+    elif args.command == "lookup":
+        index = get_imdb_index()
+        if index is None:
+            print("[IMDb索引] 尚未构建索引，请先运行 build 命令")
+        else:
+            start_time = time.perf_counter()
+            result = index.lookup(args.title, args.year)
+            print(f"[IMDb索引] {result}（用时 {(time.perf_counter() - start_time) * 1e6:.0f}微秒）")
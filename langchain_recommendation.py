@@ -1,18 +1,41 @@
 from langchain_openai import ChatOpenAI
 import os
-from dotenv import load_dotenv
+import threading
+import time
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv, find_dotenv
 from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain.agents import tool
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage
+from langchain_core.callbacks import BaseCallbackHandler
 import json
 import html
 
 # 从api_utils导入系统提示词和历史记录管理函数
-from api_utils import SYSTEM_PROMPT, add_to_history, get_messages_with_history, clear_history
+from api_utils import SYSTEM_PROMPT, add_to_history, get_messages_with_history, clear_history, get_movie_json_template
+from rate_limiter import get_limiter
+from metrics import span, record_llm
 
 
+# LangChain方式使用的模型
+LANGCHAIN_MODEL = "qwen-max"
+LANGCHAIN_MAX_ITERATIONS = int(os.getenv("LANGCHAIN_MAX_ITERATIONS", "5"))   # Agent最多调用模型/工具的轮数
+
+# 当前Agent请求的截止时间，模型和搜索工具排队时不超过其剩余时间
+_request_deadline = contextvars.ContextVar("langchain_deadline", default=None)
+
+@contextmanager
+def request_deadline(deadline):
+    """在此范围内调用模型和搜索工具时，排队不超过deadline的剩余时间，已超时时直接中止"""
+    token = _request_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _request_deadline.reset(token)
+
 # 电影推荐JSON格式模板
 MOVIE_JSON_TEMPLATE = """
 {
@@ -45,6 +68,78 @@ MOVIE_JSON_TEMPLATE = """
 }
 """
 
+class RateLimitCallbackHandler(BaseCallbackHandler):
+    """在Agent每次调用模型和搜索工具前按对应服务的配额排队，调用结束后归还并发名额"""
+    
+    raise_error = True  # 排队超时时中止Agent，而不是忽略
+    
+    def __init__(self, llm_provider="dashscope", tool_provider="tavily"):
+        self.llm_limiter = get_limiter(llm_provider)
+        self.tool_limiter = get_limiter(tool_provider)
+        self._running = {}  # run_id -> 调度器
+        self._lock = threading.Lock()
+    
+    def _acquire(self, limiter, run_id):
+        deadline = _request_deadline.get()
+        if deadline is not None:
+            # 请求已超时或被取消（如对冲请求落败）时中止Agent，不再占用配额
+            deadline.check("LangChain")
+        limiter.acquire(deadline=deadline)
+        with self._lock:
+            self._running[run_id] = limiter
+    
+    def _release(self, run_id, error=None):
+        with self._lock:
+            limiter = self._running.pop(run_id, None)
+        if limiter is None:
+            return
+        limiter.release()
+        if getattr(error, "status_code", None) == 429:
+            limiter.throttle()
+    
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._acquire(self.llm_limiter, run_id)
+    
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._release(run_id)
+    
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._release(run_id, error)
+    
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._acquire(self.tool_limiter, run_id)
+    
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._release(run_id)
+    
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._release(run_id, error)
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """记录Agent每次调用模型的耗时和输出token数"""
+    
+    def __init__(self, model=LANGCHAIN_MODEL):
+        self.model = model
+        self._started = {}  # run_id -> 开始时间
+        self._lock = threading.Lock()
+    
+    def _finish(self, run_id, tokens=None):
+        with self._lock:
+            start_time = self._started.pop(run_id, None)
+        if start_time is not None:
+            record_llm(self.model, time.perf_counter() - start_time, tokens=tokens)
+    
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        with self._lock:
+            self._started[run_id] = time.perf_counter()
+    
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        self._finish(run_id, usage.get("completion_tokens"))
+    
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
 def init_langchain():
     """初始化langchain环境和工具"""
     # 加载.env文件中的环境变量
@@ -69,14 +164,18 @@ def init_langchain():
     # 设置Tavily API环境变量
     os.environ["TAVILY_API_KEY"] = tavily_api_key
 
+    # 模型和搜索工具的每次调用都按配额排队
+    rate_limit_handler = RateLimitCallbackHandler()
+
     # 创建Tavily搜索工具
-    search_tool = TavilySearchResults(max_results=3)
+    search_tool = TavilySearchResults(max_results=3, callbacks=[rate_limit_handler])
 
     # 创建LLM
     llm = ChatOpenAI(
         api_key=dashscope_api_key,
         base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        model="qwen-max",
+        model=LANGCHAIN_MODEL,
+        callbacks=[rate_limit_handler, MetricsCallbackHandler()],
     )
     
     # 创建Agent
@@ -104,11 +203,93 @@ def init_langchain():
     
     return llm, agent_executor
 
-def get_movie_recommendation_langchain(input_text, genre, search_query=None):
+# 共享的LangChain实例，进程内只构建一次，.env文件变化时重新构建
+ENV_PATH = find_dotenv()
+_langchain_agent = (None, None)
+_langchain_config = None
+_langchain_lock = threading.Lock()
 
+def _get_config_fingerprint():
+    """获取当前配置的指纹（.env文件的修改时间）"""
+    try:
+        return os.path.getmtime(ENV_PATH) if ENV_PATH else None
+    except OSError:
+        return None
+
+def get_langchain_agent(reload=False):
+    """
+    获取共享的LangChain实例
+    
+    参数:
+        reload: 是否强制重新加载配置并重新构建
     
-    # 初始化LangChain工具
-    llm, agent_executor = init_langchain()
+    返回:
+        tuple: (llm, agent_executor)，初始化失败时为(None, None)
+    """
+    global _langchain_agent, _langchain_config
+    fingerprint = _get_config_fingerprint()
+    if not reload and _langchain_agent[1] is not None and fingerprint == _langchain_config:
+        return _langchain_agent
+    
+    with _langchain_lock:
+        # 等待锁期间可能已被其他请求构建完成
+        if not reload and _langchain_agent[1] is not None and fingerprint == _langchain_config:
+            return _langchain_agent
+        
+        if reload or _langchain_config is not None:
+            print("【LangChain】配置已变化，重新加载.env并构建LangChain实例")
+            load_dotenv(ENV_PATH, override=True)
+        
+        llm, agent_executor = init_langchain()
+        if llm and agent_executor:
+            _langchain_agent = (llm, agent_executor)
+            _langchain_config = fingerprint
+        return llm, agent_executor
+
+def reload_langchain():
+    """重新加载配置并重建LangChain实例"""
+    return get_langchain_agent(reload=True)
+
+def benchmark_langchain_init(rounds=5):
+    """
+    比较每次请求都初始化LangChain与复用共享实例的耗时
+    
+    参数:
+        rounds: 每种方式的测试次数
+    
+    返回:
+        dict: 两种方式的平均耗时(秒)
+    """
+    cold_times = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        init_langchain()
+        cold_times.append(time.perf_counter() - start_time)
+    
+    get_langchain_agent()  # 预热共享实例
+    warm_times = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        get_langchain_agent()
+        warm_times.append(time.perf_counter() - start_time)
+    
+    cold_avg = sum(cold_times) / rounds
+    warm_avg = sum(warm_times) / rounds
+    print(f"【LangChain】每次初始化平均用时: {cold_avg * 1000:.2f}毫秒")
+    print(f"【LangChain】复用共享实例平均用时: {warm_avg * 1000:.4f}毫秒")
+    return {"cold": cold_avg, "warm": warm_avg}
+
+def get_movie_recommendation_langchain(input_text, genre, search_query=None, session_id=None, count=3, deadline=None):
+    """
+    使用LangChain Agent获取电影推荐
+    
+    参数:
+        count: 推荐的电影数，大于3时多出的电影用作"换一个"的候选
+        deadline: 请求的截止时间，Agent的总运行时间和每次排队都不超过其剩余时间
+    """
+    
+    # 获取共享的LangChain实例
+    llm, agent_executor = get_langchain_agent()
     
     if not llm or not agent_executor:
         return []
@@ -119,31 +300,37 @@ def get_movie_recommendation_langchain(input_text, genre, search_query=None):
     # 构建提示词，包含要求返回JSON格式
     prompt = f"""我需要{genre}类型的电影推荐：{input_text}
     
-请根据以上描述推荐三部电影，并严格按照以下JSON格式返回。
+请根据以上描述推荐{"三" if count == 3 else count}部电影，并严格按照以下JSON格式返回。
 注意：电影标题必须同时包含中文和英文，格式为"中文标题(英文标题)"，并使用英文括号。
 所有描述和推荐理由必须使用中文，内容详细且不要透露关键剧情。
 
 搜索关键词：{query}
 
 请返回以下格式的JSON：
-{MOVIE_JSON_TEMPLATE}"""
+{MOVIE_JSON_TEMPLATE if count == 3 else get_movie_json_template(count)}"""
     
     try:
         # 获取包含历史记录的完整消息列表（用于调试目的）
-        history_messages = get_messages_with_history(prompt)
+        history_messages = get_messages_with_history(prompt, session_id)
         history_count = len(history_messages) - 2  # 减去系统消息和当前用户消息
         
         # 使用Agent获取回答
         print(f"【LangChain】发送到LangChain的提示词：{prompt[:100]}...")
-        agent_response = agent_executor.invoke({"input": prompt})
+        # 共享的Agent不随请求变化，每次请求按剩余时间创建执行器
+        executor = AgentExecutor(agent=agent_executor.agent, tools=agent_executor.tools, verbose=True,
+                                 max_iterations=LANGCHAIN_MAX_ITERATIONS,
+                                 max_execution_time=deadline.remaining() if deadline is not None else None)
+        with request_deadline(deadline), span("agent", model=LANGCHAIN_MODEL):
+            agent_response = executor.invoke({"input": prompt})
         response_text = agent_response["output"]
         
         # 添加模型回复到历史记录
         print(f"【LangChain】接收到模型回复，长度：{len(response_text)} 字符")
-        add_to_history("assistant", response_text)
+        add_to_history("assistant", response_text, session_id)
         
         # 尝试从回答中提取JSON
-        movie_recommendations = extract_movie_json(response_text)
+        with span("json_extract"):
+            movie_recommendations = extract_movie_json(response_text)
         
         # 验证推荐结果的格式
         if movie_recommendations:
@@ -166,14 +353,14 @@ def get_movie_recommendation_langchain(input_text, genre, search_query=None):
         else:
             print("【LangChain】未能提供有效的电影推荐")
             # 仍将响应添加到历史记录，但标记为解析失败
-            add_to_history("system", "【注意】LangChain响应解析失败，未能提取有效电影推荐")
+            add_to_history("system", "【注意】LangChain响应解析失败，未能提取有效电影推荐", session_id)
             
         return movie_recommendations
     except Exception as e:
         error_msg = f"LangChain推荐过程中出错: {e}"
         print(f"【LangChain】{error_msg}")
         # 记录错误到历史记录
-        add_to_history("system", f"【错误】{error_msg}")
+        add_to_history("system", f"【错误】{error_msg}", session_id)
         return []
 
 def extract_movie_json(text):
@@ -302,8 +489,15 @@ def extract_movie_json(text):
 
 # 当作为独立脚本运行时的演示代码
 if __name__ == "__main__":
+    import sys
+    
+    # 运行 python langchain_recommendation.py --bench 比较初始化开销
+    if "--bench" in sys.argv:
+        benchmark_langchain_init()
+        sys.exit(0)
+    
     # 基础演示
-    llm, agent_executor = init_langchain()
+    llm, agent_executor = get_langchain_agent()
     
     if llm and agent_executor:
         # 清空历史记录开始新会话
@@ -0,0 +1,264 @@
+import bisect
+import contextvars
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+# 加载.env文件中的环境变量
+load_dotenv()
+
+# 监控配置
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))                                          # 设为0表示不启动监控端点
+METRICS_TRACE_LOG = os.getenv("METRICS_TRACE_LOG", "false").lower() in ("1", "true", "yes")   # 每次请求结束时打印追踪摘要
+METRICS_RECENT_TRACES = int(os.getenv("METRICS_RECENT_TRACES", "50"))                         # /traces保留的最近请求数
+
+# 直方图的默认分桶(秒)，覆盖缓存命中的毫秒级到模型推理的分钟级
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """按标签累加的计数器"""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}   # 标签值 -> 累计值
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        """输出Prometheus文本格式"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    """按标签分组的累计分桶直方图"""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # 标签值 -> {"counts": 各桶计数, "sum": 总和, "count": 次数}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        """输出Prometheus文本格式，桶计数为累计值"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series['sum']:.6f}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+# 全部指标
+stage_seconds = Histogram("movie_stage_duration_seconds", "推荐各阶段耗时(秒)", ("stage", "outcome"))
+request_seconds = Histogram("movie_request_duration_seconds", "一次界面请求从开始到最后一次输出的耗时(秒)", ("handler", "outcome"))
+llm_seconds = Histogram("movie_llm_duration_seconds", "模型调用总耗时(秒)", ("model",))
+llm_first_token_seconds = Histogram("movie_llm_first_token_seconds", "模型返回首个token的耗时(秒)", ("model",))
+llm_tokens = Counter("movie_llm_output_tokens_total", "模型输出的token数（没有用量信息时按流式块数估算）", ("model",))
+METRICS = (stage_seconds, request_seconds, llm_seconds, llm_first_token_seconds, llm_tokens)
+
+class RequestTrace:
+    """一次请求的追踪：按时间顺序记录各阶段的开始时间、耗时和附加信息"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name):
+        self.id = next(self._ids)
+        self.name = name
+        self.outcome = "ok"
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+        self.spans = []   # (开始偏移, 阶段, 耗时, 附加信息)
+        self._lock = threading.Lock()
+
+    def add(self, stage, start, duration, attrs=None):
+        with self._lock:
+            self.spans.append((start - self.started_at, stage, duration, dict(attrs or {})))
+
+    def summary(self):
+        """生成可读的追踪摘要：每个阶段一行，同名阶段在末尾汇总总耗时"""
+        total = (self.finished_at or time.perf_counter()) - self.started_at
+        lines = [f"[追踪] 请求#{self.id} {self.name} {self.outcome} 总耗时 {total:.2f}秒"]
+        totals = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[0])
+        for offset, stage, duration, attrs in spans:
+            detail = " ".join(f"{key}={value}" for key, value in attrs.items())
+            lines.append(f"  +{offset:6.2f}s {stage:<12} {duration:7.3f}s {detail}".rstrip())
+            totals[stage] = totals.get(stage, 0.0) + duration
+        if totals:
+            lines.append("  合计: " + "，".join(f"{stage} {seconds:.2f}秒" for stage, seconds in totals.items()))
+        return "\n".join(lines)
+
+# 当前请求的追踪；在线程池中执行时需通过contextvars.copy_context()传递
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+_recent_traces = deque(maxlen=METRICS_RECENT_TRACES)
+
+def get_current_trace():
+    """获取当前请求的追踪，不在请求中时返回None"""
+    return _current_trace.get()
+
+@contextmanager
+def span(stage, **attrs):
+    """
+    记录一个阶段的耗时：写入阶段直方图，并追加到当前请求的追踪中
+
+    参数:
+        stage: 阶段名称
+        attrs: 附加信息，只写入追踪
+
+    返回:
+        dict: 可在阶段内设置"outcome"（如cache_hit、miss、skipped，默认ok，抛出异常时为error）及其他附加信息
+    """
+    record = dict(attrs)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record.setdefault("outcome", "error")
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        outcome = record.pop("outcome", "ok")
+        stage_seconds.observe(duration, stage=stage, outcome=outcome)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, start, duration, dict(record, outcome=outcome) if outcome != "ok" else record)
+
+def record_llm(model, duration, first_token=None, tokens=None):
+    """记录一次模型调用的总耗时、首个token耗时和输出token数"""
+    llm_seconds.observe(duration, model=model)
+    if first_token is not None:
+        llm_first_token_seconds.observe(first_token, model=model)
+    if tokens:
+        llm_tokens.inc(tokens, model=model)
+
+def traced(handler, results):
+    """
+    将一次界面请求的生成器包装为一次请求追踪
+
+    生成器的每一步都在同一个独立的上下文中运行，期间各阶段（包括提交到线程池的任务）都记录到本次请求的追踪中；
+    每次产出后到Gradio再次取下一个结果之间的时间记为render阶段（界面组件的后处理和发送）。
+
+    参数:
+        handler: 请求处理函数的名称，用作指标标签
+        results: 产出界面输出的生成器
+    """
+    trace = RequestTrace(handler)
+    context = contextvars.copy_context()
+    context.run(_current_trace.set, trace)
+    try:
+        while True:
+            try:
+                item = context.run(next, results)
+            except StopIteration:
+                break
+            yielded_at = time.perf_counter()
+            yield item
+            duration = time.perf_counter() - yielded_at
+            stage_seconds.observe(duration, stage="render", outcome="ok")
+            trace.add("render", yielded_at, duration)
+    except GeneratorExit:
+        trace.outcome = "cancelled"
+        raise
+    except Exception:
+        trace.outcome = "error"
+        raise
+    finally:
+        context.run(results.close)
+        trace.finished_at = time.perf_counter()
+        request_seconds.observe(trace.finished_at - trace.started_at, handler=handler, outcome=trace.outcome)
+        summary = trace.summary()
+        _recent_traces.append(summary)
+        if METRICS_TRACE_LOG:
+            print(summary)
+
+def render_metrics():
+    """输出全部指标的Prometheus文本格式"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def get_recent_traces():
+    """获取最近请求的追踪摘要，最新的在前"""
+    return list(reversed(_recent_traces))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics输出Prometheus指标，/traces输出最近请求的追踪摘要"""
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body, content_type = render_metrics(), "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/traces":
+            body, content_type = "\n\n".join(get_recent_traces()) + "\n", "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # 不输出每次抓取的访问日志
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """在后台线程中启动监控端点，重复调用时只启动一次；端口为0或被占用时不启动"""
+    global _metrics_server
+    if port <= 0:
+        return None
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                print(f"[监控] 无法在 {host}:{port} 启动监控端点: {e}")
+                return None
+            _metrics_server.daemon_threads = True
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics", daemon=True).start()
+            print(f"[监控] Prometheus指标: http://{host}:{port}/metrics，最近请求追踪: http://{host}:{port}/traces")
+    return _metrics_server
@@ -0,0 +1,292 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+
+# 本地电影目录配置
+CATALOG_DIR = "movie_catalog"
+CATALOG_PATH = os.path.join(CATALOG_DIR, "catalog.json")
+CATALOG_COMPACT_LINES = 500   # 追加日志超过这么多条时在后台合并回目录文件
+
+# OMDb英文类型到界面中文类型的映射
+GENRE_MAP = {
+    "action": "动作", "comedy": "喜剧", "drama": "剧情", "sci-fi": "科幻", "horror": "恐怖",
+    "mystery": "悬疑", "thriller": "惊悚", "romance": "爱情", "war": "战争", "western": "西部",
+    "fantasy": "奇幻", "animation": "动画", "documentary": "纪录片", "music": "音乐/歌舞",
+    "musical": "音乐/歌舞", "adventure": "冒险", "biography": "传记", "crime": "犯罪",
+    "family": "家庭", "history": "历史", "sport": "体育"
+}
+
+# 模型返回的中文类型写法到界面类型的映射
+GENRE_ALIASES = {"纪录": "纪录片", "音乐": "音乐/歌舞", "歌舞": "音乐/歌舞", "运动": "体育", "传记片": "传记"}
+
+# 界面上可选、但OMDb没有对应类型的中文类型，只能从模型返回的类型中获得
+EXTRA_GENRES = {"武侠", "灾难", "间谍", "真人动画"}
+KNOWN_GENRES = set(GENRE_MAP.values()) | EXTRA_GENRES
+
+# 界面上的语言、地区选项与OMDb字段中关键词的对应关系
+LANGUAGE_MAP = {"国语": ("mandarin", "chinese"), "英语": ("english",)}
+REGION_MAP = {"中国": ("china", "hong kong", "taiwan"), "美国": ("united states", "usa")}
+
+def parse_year(value):
+    """从"2010"、"2010年"、"2010–2014"等格式中解析年份"""
+    match = re.search(r'(18|19|20)\d{2}', str(value or ""))
+    return int(match.group(0)) if match else None
+
+def parse_rating(value):
+    """从"8.8"、"8.8/10"、"豆瓣9.3"等格式中解析10分制评分"""
+    match = re.search(r'\d+(\.\d+)?', str(value or ""))
+    if not match:
+        return None
+    rating = float(match.group(0))
+    return rating if 0 <= rating <= 10 else None
+
+def parse_genres(*values):
+    """将OMDb的英文类型和模型返回的中文类型统一为界面上的中文类型"""
+    genres = set()
+    for value in values:
+        for part in re.split(r'[/,，、\s]+', str(value or "")):
+            part = part.strip()
+            if not part:
+                continue
+            genre = GENRE_MAP.get(part.lower()) or GENRE_ALIASES.get(part, part)
+            # 去掉"片"后缀，如"科幻片"
+            if genre not in KNOWN_GENRES and genre.endswith("片") and genre[:-1] in KNOWN_GENRES:
+                genre = genre[:-1]
+            if genre in KNOWN_GENRES:
+                genres.add(genre)
+    return sorted(genres)
+
+class MovieCatalog:
+    """本地电影目录：积累通过OMDb和模型获取过的电影，并维护类型、年代和评分段的内存二级索引"""
+
+    def __init__(self, path=CATALOG_PATH, compact_lines=CATALOG_COMPACT_LINES):
+        """
+        参数:
+            path: 目录文件路径，新增的电影先追加到同目录下的.log文件，再定期合并回目录文件
+            compact_lines: 追加日志超过这么多条时在后台合并
+        """
+        self.path = path
+        self.log_path = f"{path}.log"
+        self.compact_lines = compact_lines
+        self._movies = {}               # 电影键 -> 电影记录
+        self._title_keys = {}           # 标题|年份 -> 电影键，已知imdbID后同一部电影只保留一条记录
+        self._genre_index = {}          # 类型 -> 电影键集合
+        self._decade_index = {}         # 年代(如2010) -> 电影键集合
+        self._rating_index = {}         # 评分段(评分取整) -> 电影键集合
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()   # 同一时刻只进行一次合并
+        self._log_lines = 0
+        self._compacting = False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._load()
+        atexit.register(self.compact)
+
+    def _load(self):
+        """从磁盘加载目录，重放追加日志并重建索引；有未合并的日志时合并一次"""
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for record in json.load(f):
+                        self._index(record)
+            # 上次合并中断时留下的旧日志先于当前日志重放
+            for log_path in (f"{self.log_path}.compacting", self.log_path):
+                if not os.path.exists(log_path):
+                    continue
+                with open(log_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            self._index(json.loads(line))
+                            self._log_lines += 1
+                        except ValueError:
+                            continue  # 写了一半的最后一行
+            if self._movies:
+                print(f"[电影目录] 已加载 {len(self._movies)} 部电影")
+        except Exception as e:
+            print(f"[电影目录] 加载目录失败: {e}")
+        if self._log_lines:
+            self.compact()
+
+    def _append_log(self, record):
+        """将新增的记录追加到日志（调用方需持有锁），日志过长时在后台合并"""
+        try:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._log_lines += 1
+        except OSError as e:
+            print(f"[电影目录] 写入日志失败: {e}")
+        if self._log_lines >= self.compact_lines and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self.compact, name="catalog_compact", daemon=True).start()
+
+    def compact(self):
+        """将目录整体写入目录文件并清空追加日志，在后台线程、启动时和退出时调用"""
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        with self._lock:
+            if not self._log_lines:
+                self._compacting = False
+                return
+            records = list(self._movies.values())
+            # 之后新增的记录写入新的日志；旧日志在目录文件写入成功后才删除
+            compacting_path = f"{self.log_path}.compacting"
+            try:
+                if os.path.exists(self.log_path):
+                    os.replace(self.log_path, compacting_path)
+            except OSError as e:
+                print(f"[电影目录] 合并日志失败: {e}")
+                self._compacting = False
+                return
+            self._log_lines = 0
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(records, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            if os.path.exists(compacting_path):
+                os.remove(compacting_path)
+        except OSError as e:
+            print(f"[电影目录] 保存目录失败: {e}")
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    @staticmethod
+    def _get_key(record):
+        """电影键：优先使用imdbID，否则使用标题和年份"""
+        return record.get("imdb_id") or MovieCatalog._get_title_key(record)
+
+    @staticmethod
+    def _get_title_key(record):
+        return f"{record['title'].lower()}|{record.get('year') or ''}"
+
+    def _index(self, record):
+        """加入记录并更新索引（调用方需持有锁）；同一部电影按imdbID只保留一条，没有imdbID的记录并入已有的imdbID记录"""
+        title_key = self._get_title_key(record)
+        existing_key = self._title_keys.get(title_key)
+        if not record.get("imdb_id") and existing_key and existing_key != title_key and existing_key in self._movies:
+            # 这次没有拿到OMDb数据，用已知的元数据补全
+            for field, value in self._movies[existing_key].items():
+                if not record.get(field):
+                    record[field] = value
+        key = self._get_key(record)
+        if key != title_key and title_key in self._movies:
+            # 已知imdbID后删除之前按标题和年份保存的记录
+            self._unindex(title_key)
+        if key in self._movies:
+            self._unindex(key)
+        self._title_keys[title_key] = key
+        self._movies[key] = record
+        for genre in record.get("genres", []):
+            self._genre_index.setdefault(genre, set()).add(key)
+        if record.get("year"):
+            self._decade_index.setdefault(record["year"] // 10 * 10, set()).add(key)
+        if record.get("rating") is not None:
+            self._rating_index.setdefault(int(record["rating"]), set()).add(key)
+
+    def _unindex(self, key):
+        """从索引中移除记录（调用方需持有锁）"""
+        record = self._movies.pop(key)
+        for genre in record.get("genres", []):
+            self._genre_index.get(genre, set()).discard(key)
+        if record.get("year"):
+            self._decade_index.get(record["year"] // 10 * 10, set()).discard(key)
+        if record.get("rating") is not None:
+            self._rating_index.get(int(record["rating"]), set()).discard(key)
+
+    def add_movie(self, movie, omdb_data=None):
+        """
+        将模型推荐的电影（以及OMDb返回的元数据）加入目录
+
+        参数:
+            movie: 模型返回的电影字典
+            omdb_data: get_movie_metadata返回的OMDb数据，可为None
+        """
+        omdb_data = omdb_data or {}
+        title = movie.get("title")
+        if not title:
+            return
+        poster = omdb_data.get("Poster")
+        record = {
+            "title": title,
+            "year": parse_year(omdb_data.get("Year")) or parse_year(movie.get("year")),
+            "genres": parse_genres(omdb_data.get("Genre"), movie.get("genre")),
+            "rating": parse_rating(omdb_data.get("imdbRating")) or parse_rating(movie.get("rating")),
+            "language": omdb_data.get("Language", ""),
+            "country": omdb_data.get("Country", ""),
+            "poster": poster if poster and poster != "N/A" else "",
+            "imdb_id": omdb_data.get("imdbID", ""),
+            "description": movie.get("description", ""),
+            "updated_at": time.time()
+        }
+        with self._lock:
+            self._index(record)
+            self._append_log(record)
+
+    @staticmethod
+    def _matches_any(text, keywords):
+        text = text.lower()
+        return any(keyword in text for keyword in keywords)
+
+    def find_movies(self, genres=None, min_year=None, min_rating=None, language=None, region=None, limit=3, exclude=()):
+        """
+        按筛选条件查找电影
+
+        参数:
+            genres: 类型列表，满足任一类型即可，匹配类型越多排名越靠前
+            min_year: 最早年份
+            min_rating: 最低评分
+            language: 界面上的语言选项，"无"表示不限
+            region: 界面上的地区选项，"无"表示不限
+            limit: 最多返回数量
+            exclude: 需要排除的电影标题
+
+        返回:
+            list: 电影记录，按匹配类型数和评分排序
+        """
+        with self._lock:
+            candidates = set(self._movies)
+            if genres:
+                candidates &= set().union(*(self._genre_index.get(genre, set()) for genre in genres))
+            if min_year:
+                candidates &= set().union(*(keys for decade, keys in self._decade_index.items()
+                                            if decade >= int(min_year) // 10 * 10))
+            if min_rating:
+                candidates &= set().union(*(keys for bucket, keys in self._rating_index.items()
+                                            if bucket >= int(min_rating)))
+
+            results = []
+            for key in candidates:
+                record = self._movies[key]
+                if record["title"] in exclude:
+                    continue
+                if min_year and (record.get("year") or 0) < min_year:
+                    continue
+                if min_rating and (record.get("rating") or 0) < min_rating:
+                    continue
+                if language in LANGUAGE_MAP and not self._matches_any(record.get("language", ""), LANGUAGE_MAP[language]):
+                    continue
+                if region in REGION_MAP and not self._matches_any(record.get("country", ""), REGION_MAP[region]):
+                    continue
+                results.append(record)
+
+        genre_set = set(genres or [])
+        results.sort(key=lambda record: (len(genre_set & set(record.get("genres", []))), record.get("rating") or 0), reverse=True)
+        return [dict(record) for record in results[:limit]]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._movies)
+
+# 创建全局电影目录实例
+movie_catalog = MovieCatalog()
+
+# 查看目录规模：python movie_catalog.py
+if __name__ == "__main__":
+    print(f"[电影目录] 共 {len(movie_catalog)} 部电影")
+    for genre in sorted(movie_catalog._genre_index):
+        print(f"  {genre}: {len(movie_catalog._genre_index[genre])}")
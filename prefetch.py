@@ -0,0 +1,204 @@
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from api_utils import DEFAULT_SESSION, fork_history, adopt_fork_history, discard_fork_history, record_user_reaction
+from recommendation import recommend_text, recommend_pool_page, candidate_pool, FEEDBACK_PROMPT, PAGE_SIZE
+from rate_limiter import PriorityHandle, run_with_priority
+from deadline import Deadline
+
+# "换一个"预取配置，可在.env中覆盖
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")  # 是否在推荐完成后预取下一批
+PREFETCH_MAX_JOBS = int(os.getenv("PREFETCH_MAX_JOBS", "2"))                              # 全局同时进行的预取任务数上限
+
+class FeedbackPrefetcher:
+    """
+    "换一个"的推测性预取：每次推荐完成后在后台为该会话计算下一批推荐（排除已展示的电影），
+    用户点击"换一个"时直接返回。预取在临时会话上进行，结果被使用时才合并到真实会话历史。
+    """
+
+    def __init__(self, max_jobs=PREFETCH_MAX_JOBS, enabled=PREFETCH_ENABLED):
+        """
+        参数:
+            max_jobs: 全局同时进行的预取任务数上限，达到上限时不再发起新的预取
+            enabled: 是否启用预取
+        """
+        self.enabled = enabled
+        self._slots = {}    # 会话ID -> {"future", "cancel", "priority", "use_langchain", "fork_id"}
+        self._shown = {}    # 会话ID -> 本轮查询已展示过的电影标题
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(max_jobs)
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="prefetch")
+        self._fork_counter = itertools.count(1)
+        self.stats = {"scheduled": 0, "served": 0, "missed": 0, "cancelled": 0, "skipped": 0}
+
+    def _get_fork_id(self, session_id):
+        """每次预取使用独立的临时会话，避免被取消但仍在运行的任务写入新任务的历史"""
+        return f"{session_id}#prefetch-{next(self._fork_counter)}"
+
+    @staticmethod
+    def _discard_fork(fork_id):
+        """删除临时会话的历史记录和候选池"""
+        discard_fork_history(fork_id)
+        candidate_pool.clear(fork_id)
+
+    def _cancel_slot(self, session_id):
+        """取消会话的预取任务，任务结束后删除其临时会话（调用方需持有锁）"""
+        slot = self._slots.pop(session_id, None)
+        if slot is None:
+            return
+        slot["cancel"].set()
+        slot["future"].cancel()
+        fork_id = slot["fork_id"]
+        slot["future"].add_done_callback(lambda future: self._discard_fork(fork_id))
+        self.stats["cancelled"] += 1
+        print(f"[预取] 已取消会话 {session_id} 的预取")
+
+    def reset(self, session_id):
+        """用户发起新查询：取消预取并清空已展示的电影"""
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            self._cancel_slot(session_id)
+            self._shown.pop(session_id, None)
+
+    def remember(self, session_id, result):
+        """记录已展示给用户的电影标题"""
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            shown = self._shown.setdefault(session_id, [])
+            for i in range(3):
+                title = result.get(f"title{i}")
+                if title and title not in shown:
+                    shown.append(title)
+
+    def get_shown_titles(self, session_id):
+        """获取会话已展示过的电影标题"""
+        with self._lock:
+            return list(self._shown.get(session_id or DEFAULT_SESSION, []))
+
+    def schedule(self, session_id, use_langchain=False):
+        """为会话在后台预取下一批推荐，候选池中还有电影或已达到全局并发上限时跳过"""
+        if not self.enabled:
+            return
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            self._cancel_slot(session_id)
+            if candidate_pool.remaining(session_id):
+                return
+            if not self._semaphore.acquire(blocking=False):
+                self.stats["skipped"] += 1
+                print(f"[预取] 预取任务已达上限，跳过会话 {session_id}")
+                return
+            fork_id = self._get_fork_id(session_id)
+            fork_history(session_id, fork_id)
+            cancel = threading.Event()
+            exclude_titles = list(self._shown.get(session_id, []))
+            # 预取是推测性请求，外部服务配额紧张时让位于用户正在等待的请求；用户等待其结果时再提升为交互优先级
+            priority = PriorityHandle()
+            future = self._executor.submit(run_with_priority, priority, self._run, fork_id, use_langchain, exclude_titles, cancel)
+            # 任务完成或在开始前被取消时都释放并发名额
+            future.add_done_callback(lambda future: self._semaphore.release())
+            self._slots[session_id] = {"future": future, "cancel": cancel, "priority": priority,
+                                       "use_langchain": use_langchain, "fork_id": fork_id}
+            self.stats["scheduled"] += 1
+            print(f"[预取] 已开始为会话 {session_id} 预取下一批推荐")
+
+    def _run(self, fork_id, use_langchain, exclude_titles, cancel):
+        """在临时会话上计算下一批推荐，被取消或出错时返回None"""
+        result = None
+        results = recommend_text(FEEDBACK_PROMPT, "", use_langchain=use_langchain, stream=True,
+                                 session_id=fork_id, exclude_titles=exclude_titles, pool_size=PAGE_SIZE)
+        for result in results:
+            if cancel.is_set():
+                results.close()
+                return None
+        if result is None or "error" in result:
+            self._discard_fork(fork_id)
+            return None
+        return result
+
+    def take(self, session_id, use_langchain=False, deadline=None):
+        """
+        取出会话的预取结果，并将预取时产生的历史记录和候选池合并到真实会话
+
+        参数:
+            deadline: 请求的截止时间，进行中的预取最多等待到截止时间
+
+        返回:
+            dict: 预取的推荐结果；没有可用结果时返回None（尚未开始的任务会被取消，进行中的任务提升为交互优先级后等待其完成）
+        """
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            slot = self._slots.get(session_id)
+            if slot is None or slot["use_langchain"] != use_langchain or slot["future"].cancel():
+                self._cancel_slot(session_id)
+                self.stats["missed"] += 1
+                return None
+            del self._slots[session_id]
+
+        if not slot["future"].done():
+            # 用户正在等待这次预取，其后续的外部请求不再让位于其他交互请求
+            slot["priority"].promote()
+            print(f"[预取] 会话 {session_id} 正在等待进行中的预取，已提升为交互优先级")
+        try:
+            result = slot["future"].result(timeout=deadline.remaining() if deadline is not None else None)
+        except FuturesTimeoutError:
+            print(f"[预取] 会话 {session_id} 等待预取超出请求时间预算，已取消")
+            slot["cancel"].set()
+            fork_id = slot["fork_id"]
+            slot["future"].add_done_callback(lambda future: self._discard_fork(fork_id))
+            result = None
+        if result is None:
+            with self._lock:
+                self.stats["missed"] += 1
+            return None
+        record_user_reaction("不喜欢，要求换一批", session_id)
+        adopt_fork_history(slot["fork_id"], session_id)
+        candidate_pool.adopt(slot["fork_id"], session_id)
+        with self._lock:
+            self.stats["served"] += 1
+        print(f"[预取] 会话 {session_id} 使用预取结果")
+        return result
+
+    def track(self, results, session_id, use_langchain=False):
+        """
+        包装一次新查询的推荐结果：开始前取消旧的预取，成功完成后记录已展示的电影并预取下一批
+
+        返回:
+            generator: 原样产出推荐结果
+        """
+        self.reset(session_id)
+        result = {}
+        for result in results:
+            yield result
+        if "error" not in result:
+            self.remember(session_id, result)
+            self.schedule(session_id, use_langchain)
+
+# 创建全局预取器实例
+feedback_prefetcher = FeedbackPrefetcher()
+
+def recommend_feedback(use_langchain=False, session_id=None):
+    """
+    "换一个"：依次尝试候选池的下一页、预取好的下一批推荐，都没有时实时请求，完成后继续预取下一批
+
+    返回:
+        generator: 逐步更新的结果字典
+    """
+    deadline = Deadline()
+    page = candidate_pool.next_page(session_id, use_langchain)
+    result = None if page else feedback_prefetcher.take(session_id, use_langchain, deadline)
+    if page:
+        result = {}
+        for result in recommend_pool_page(page, session_id, deadline):
+            yield result
+    elif result is not None:
+        yield result
+    else:
+        result = {}
+        for result in recommend_text(FEEDBACK_PROMPT, "", use_langchain=use_langchain, stream=True, session_id=session_id,
+                                     exclude_titles=feedback_prefetcher.get_shown_titles(session_id), deadline=deadline):
+            yield result
+    if "error" not in result:
+        feedback_prefetcher.remember(session_id, result)
+        feedback_prefetcher.schedule(session_id, use_langchain)
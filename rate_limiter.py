@@ -0,0 +1,226 @@
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# 加载.env文件中的环境变量
+load_dotenv()
+
+# 请求优先级：数值越小越优先
+INTERACTIVE = 0   # 用户正在等待的请求
+BACKGROUND = 1    # 预取、候选池海报等推测性请求
+
+# 没有请求截止时间时排队等待的最长时间(秒)，超时后放弃请求，由调用方按请求失败处理；有截止时间时按其剩余时间排队
+RATE_LIMIT_INTERACTIVE_WAIT = float(os.getenv("RATE_LIMIT_INTERACTIVE_WAIT", "15"))
+RATE_LIMIT_BACKGROUND_WAIT = float(os.getenv("RATE_LIMIT_BACKGROUND_WAIT", "60"))
+RATE_LIMIT_THROTTLE_SECONDS = float(os.getenv("RATE_LIMIT_THROTTLE_SECONDS", "2"))   # 收到429且没有Retry-After时暂停的时间(秒)
+
+# 各服务的默认配额：(每秒请求数, 突发容量, 最大并发数)，可在.env中通过RATE_LIMIT_<服务>_RPS/_BURST/_CONCURRENCY覆盖，设为0表示不限制
+PROVIDER_DEFAULTS = {
+    "omdb": (5, 10, 4),
+    "tavily": (2, 5, 3),
+    "modelscope_image": (0.5, 2, 2),
+    "deepseek": (1, 3, 4),
+    "dashscope": (2, 5, 4)
+}
+
+class RateLimitTimeout(Exception):
+    """排队超过等待时间仍未获得配额"""
+
+class PriorityHandle:
+    """可在进行中提升的优先级：后台任务的结果转为用户正在等待时调用promote，之后的请求和已在排队的请求都按交互优先级处理"""
+    
+    def __init__(self, value=BACKGROUND):
+        self.value = value
+    
+    def promote(self):
+        self.value = INTERACTIVE
+        # 唤醒排队中的请求，按新的优先级重新排队
+        for limiter in rate_limiters.values():
+            limiter.wake()
+
+# 当前请求的优先级（数值或PriorityHandle），在线程池中执行时需通过contextvars.copy_context()传递
+_request_priority = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+@contextmanager
+def background_priority():
+    """在此范围内发起的外部请求按后台优先级排队"""
+    token = _request_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+def run_in_background(fn, *args, **kwargs):
+    """以后台优先级执行函数，用于提交到线程池的推测性任务"""
+    with background_priority():
+        return fn(*args, **kwargs)
+
+def run_with_priority(handle, fn, *args, **kwargs):
+    """以可提升的优先级执行函数，handle.promote()后其中发起的请求改按交互优先级排队"""
+    token = _request_priority.set(handle)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _request_priority.reset(token)
+
+class ProviderLimiter:
+    """单个外部服务的令牌桶+最大并发调度器：请求按(优先级, 截止时间)排队，交互请求总是先于后台请求获得配额"""
+
+    def __init__(self, name, rate, burst, max_in_flight):
+        """
+        参数:
+            name: 服务名称
+            rate: 每秒补充的令牌数，<=0表示不限速
+            burst: 令牌桶容量，即允许的突发请求数
+            max_in_flight: 最大同时进行的请求数，<=0表示不限制
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_in_flight = max_in_flight
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._waiters = []   # 最小堆：(优先级, 截止时间, 序号)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self.stats = {"granted": 0, "queued": 0, "timeouts": 0, "throttled": 0, "wait_seconds": 0.0}
+
+    def _refill(self, now):
+        """按经过的时间补充令牌（调用方需持有锁）"""
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _get_wait(self, now, deadline):
+        """队首请求还需等待的时间（调用方需持有锁）"""
+        wait = deadline - now
+        if now < self._paused_until:
+            wait = min(wait, self._paused_until - now)
+        elif self.rate > 0 and self._tokens < 1:
+            wait = min(wait, (1 - self._tokens) / self.rate)
+        return max(wait, 0.001)
+
+    def acquire(self, priority=None, timeout=None, deadline=None):
+        """
+        排队获取一个请求配额，获得后需调用release
+
+        参数:
+            priority: INTERACTIVE、BACKGROUND或PriorityHandle，为None时使用当前上下文的优先级
+            timeout: 最长等待时间(秒)，为None时有截止时间则等到截止时间，否则按优先级使用默认值
+            deadline: 请求的截止时间(Deadline)，等待时间不超过其剩余时间
+
+        异常:
+            RateLimitTimeout: 超过等待时间仍未获得配额
+        """
+        priority = _request_priority.get() if priority is None else priority
+        handle = priority if isinstance(priority, PriorityHandle) else None
+        if handle is not None:
+            priority = handle.value
+        if deadline is not None:
+            timeout = deadline.remaining() if timeout is None else min(timeout, deadline.remaining())
+        elif timeout is None:
+            timeout = RATE_LIMIT_INTERACTIVE_WAIT if priority == INTERACTIVE else RATE_LIMIT_BACKGROUND_WAIT
+        start_time = time.monotonic()
+        entry = (priority, start_time + timeout, next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            queued = False
+            while True:
+                if handle is not None and handle.value < entry[0]:
+                    # 排队期间优先级被提升，按新的优先级重新排队
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    entry = (handle.value,) + entry[1:]
+                    heapq.heappush(self._waiters, entry)
+                    priority = handle.value
+                now = time.monotonic()
+                self._refill(now)
+                if (self._waiters[0] is entry and now >= self._paused_until
+                        and (self.rate <= 0 or self._tokens >= 1)
+                        and (self.max_in_flight <= 0 or self._in_flight < self.max_in_flight)):
+                    heapq.heappop(self._waiters)
+                    if self.rate > 0:
+                        self._tokens -= 1
+                    self._in_flight += 1
+                    self.stats["granted"] += 1
+                    self.stats["wait_seconds"] += now - start_time
+                    # 让下一个排队的请求重新检查
+                    self._cond.notify_all()
+                    return
+                if now >= entry[1]:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self.stats["timeouts"] += 1
+                    self._cond.notify_all()
+                    raise RateLimitTimeout(f"{self.name}请求排队超过{timeout:.1f}秒")
+                if not queued:
+                    queued = True
+                    self.stats["queued"] += 1
+                    print(f"[限流] {self.name} 请求排队中（{'交互' if priority == INTERACTIVE else '后台'}）")
+                self._cond.wait(self._get_wait(now, entry[1]) if self._waiters[0] is entry else entry[1] - now)
+
+    def wake(self):
+        """唤醒排队中的请求重新检查"""
+        with self._cond:
+            self._cond.notify_all()
+    
+    def release(self):
+        """归还并发名额"""
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def throttle(self, retry_after=None):
+        """服务端返回429时清空令牌并暂停一段时间"""
+        try:
+            seconds = float(retry_after) if retry_after else RATE_LIMIT_THROTTLE_SECONDS
+        except (TypeError, ValueError):
+            seconds = RATE_LIMIT_THROTTLE_SECONDS
+        with self._cond:
+            self._tokens = 0
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self.stats["throttled"] += 1
+            self._cond.notify_all()
+        print(f"[限流] {self.name} 返回429，暂停 {seconds:.1f} 秒")
+
+    @contextmanager
+    def limit(self, priority=None, timeout=None, deadline=None):
+        """在获得配额的范围内发起请求，结束时自动归还并发名额"""
+        self.acquire(priority, timeout, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self):
+        with self._cond:
+            return dict(self.stats, in_flight=self._in_flight, waiting=len(self._waiters))
+
+def _create_limiter(name, defaults):
+    """按.env配置创建服务的调度器"""
+    prefix = f"RATE_LIMIT_{name.upper()}"
+    rate, burst, max_in_flight = defaults
+    return ProviderLimiter(
+        name,
+        rate=float(os.getenv(f"{prefix}_RPS", str(rate))),
+        burst=float(os.getenv(f"{prefix}_BURST", str(burst))),
+        max_in_flight=int(os.getenv(f"{prefix}_CONCURRENCY", str(max_in_flight)))
+    )
+
+# 全局调度器实例，每个外部服务一个
+rate_limiters = {name: _create_limiter(name, defaults) for name, defaults in PROVIDER_DEFAULTS.items()}
+
+def get_limiter(name):
+    """获取外部服务的调度器"""
+    return rate_limiters[name]
+
+def get_rate_limit_stats():
+    """获取各服务的排队统计"""
+    return {name: limiter.get_stats() for name, limiter in rate_limiters.items()}
@@ -1,13 +1,34 @@
 import json
+import re
 import time
 import os
+import hashlib
+import threading
+import itertools
+import queue
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from openai import RateLimitError
 from api_utils import (
-    client, extract_json_content, get_messages_with_history, add_to_history, 
-    generate_image_ByAI, get_movie_poster, show_movie_poster, 
-    tavily_search
+    DEFAULT_SESSION, client, extract_json_content, get_messages_with_history, add_to_history, record_user_reaction,
+    fork_history, adopt_fork_history, discard_fork_history,
+    get_movie_json_template, IncrementalMovieParser, get_ai_poster, get_movie_metadata, get_movie_poster, show_movie_poster, 
+    tavily_search, pack_search_context, LRUCache, llm_flight
 )
 # 导入langchain推荐功能
 import langchain_recommendation as langchain_recommender
+from semantic_cache import semantic_cache, normalize_query
+from movie_catalog import movie_catalog
+from fuzzy_index import fuzzy_index
+from rate_limiter import get_limiter, run_in_background
+from deadline import Deadline, REQUEST_SLO_SECONDS, DEADLINE_SEARCH_MIN_SECONDS
+from metrics import span, record_llm
+
+# 普通方式使用的模型
+DEEPSEEK_MODEL = 'deepseek-ai/DeepSeek-R1'
+
+# 提示词版本，修改提示词模板后需递增，使旧的模型响应缓存失效
+PROMPT_VERSION = "1"
 
 # 电影推荐JSON格式模板
 MOVIE_JSON_TEMPLATE = """
@@ -41,69 +62,590 @@ MOVIE_JSON_TEMPLATE = """
 }
 """
 
+# 本地片库选片时只让模型写推荐理由的JSON格式模板
+REASON_JSON_TEMPLATE = """
+{
+  "movie_recommendations": [
+    {
+      "title": "电影标题",
+      "reason": "推荐理由"
+    }
+  ]
+}
+"""
+
 # 不再需要初始化search_engine，使用api_utils中的tavily_search函数
 
-def get_movie_recommendation(input_text, genre, search_query=None, use_langchain=False):
-    """从API获取电影推荐"""
+# 模型响应缓存：输入完全由界面选项决定的推荐模式，相同选项直接复用模型结果
+LLM_RESPONSE_CACHE_TTL = float(os.getenv("LLM_RESPONSE_CACHE_TTL", "21600"))   # 缓存过期时间(秒)，默认6小时
+LLM_RESPONSE_CACHE_ITEMS = int(os.getenv("LLM_RESPONSE_CACHE_ITEMS", "256"))   # 最多缓存的响应数
+llm_response_cache = LRUCache(max_items=LLM_RESPONSE_CACHE_ITEMS, ttl_seconds=LLM_RESPONSE_CACHE_TTL)
+
+# "换一个"按钮发送给模型的反馈提示
+FEEDBACK_PROMPT = "The user didn't like your previous recommendation. Please recommend another movie and reduce recommendations of this type in the future."
+
+# 并发获取电影详情（OMDb、海报下载、AI生成海报）的线程数，可在.env中通过DETAIL_FETCH_WORKERS配置
+DETAIL_FETCH_WORKERS = int(os.getenv("DETAIL_FETCH_WORKERS", "3"))
+
+# 本地片库中满足筛选条件的电影达到该数量时，筛选推荐直接从片库选片，模型只写推荐理由
+CATALOG_MIN_CANDIDATES = int(os.getenv("CATALOG_MIN_CANDIDATES", "3"))
+# 片库选片时推荐理由生成前显示的占位文字
+CATALOG_REASON_PLACEHOLDER = "正在生成推荐理由..."
+
+# 候选池：一次让模型多推荐一些电影，"换一个"时先在候选池中翻页，用完或换了查询才再次调用模型
+CANDIDATE_POOL_SIZE = int(os.getenv("CANDIDATE_POOL_SIZE", "3"))   # 每次请求的电影数，默认3表示不使用候选池，设为9等值时多出的电影放入候选池
+PAGE_SIZE = 3                                                      # 每页展示的电影数
+
+# 遗忘检索的本地候选配置，覆盖率为描述中的词项被候选电影文本命中的比例
+FUZZY_SHORTLIST_SIZE = int(os.getenv("FUZZY_SHORTLIST_SIZE", "5"))                        # 交给模型参考的候选数
+FUZZY_MIN_COVERAGE = float(os.getenv("FUZZY_MIN_COVERAGE", "0.3"))                        # 低于该覆盖率的候选不采用
+FUZZY_SKIP_SEARCH_COVERAGE = float(os.getenv("FUZZY_SKIP_SEARCH_COVERAGE", "0.6"))        # 最佳候选达到该覆盖率时不再调用Tavily
+
+# 对冲请求：所选模型在HEDGE_DELAY_SECONDS内没有解析出电影时，同时请求另一个模型，先给出有效结果的一方胜出
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_DELAY_SECONDS = float(os.getenv("HEDGE_DELAY_SECONDS", "8"))
+HEDGE_LATENCY_SMOOTHING = 0.2   # 各模型首部电影耗时的指数移动平均系数，用于估算节省的时间
+
+def iter_deepseek_content(messages, deadline=None):
+    """以流式方式调用DeepSeek，建立请求前按配额排队，逐段产出回答内容（推理内容直接丢弃）；超出请求截止时间时停止接收"""
+    limiter = get_limiter("deepseek")
+    options = {"timeout": deadline.limit(REQUEST_SLO_SECONDS)} if deadline is not None else {}
+    limiter.acquire(deadline=deadline)
+    with span("llm", model=DEEPSEEK_MODEL) as stage:
+        start_time = time.perf_counter()
+        first_token = None
+        tokens = 0   # 没有用量信息时按流式块数估算输出token数
+        try:
+            response = client.chat.completions.create(
+                model=DEEPSEEK_MODEL,
+                messages=messages,
+                stream=True,
+                **options
+            )
+        except RateLimitError as e:
+            limiter.throttle(e.response.headers.get("Retry-After"))
+            raise
+        finally:
+            # 并发名额只在建立请求时占用，不随整个流式输出（包括可能长达数分钟的推理阶段）一直占用
+            limiter.release()
+        try:
+            for chunk in response:
+                if deadline is not None and deadline.expired():
+                    print("【调试信息】超出请求时间预算，停止接收模型输出")
+                    stage["outcome"] = "timeout"
+                    break
+                if first_token is None and chunk.choices:
+                    first_token = time.perf_counter() - start_time
+                usage = getattr(chunk, "usage", None)
+                if usage is not None and usage.completion_tokens:
+                    tokens = usage.completion_tokens
+                elif chunk.choices:
+                    tokens += 1
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except GeneratorExit:
+            stage["outcome"] = "cancelled"
+            raise
+        finally:
+            # 对冲请求落败或调用方提前结束时关闭连接，不再继续生成
+            response.close()
+            record_llm(DEEPSEEK_MODEL, time.perf_counter() - start_time, first_token, tokens)
+            stage["first_token"] = f"{first_token:.2f}s" if first_token is not None else "-"
+            stage["tokens"] = tokens
+
+def iter_movie_recommendation(input_text, genre, search_query=None, use_langchain=False, session_id=None, use_search=True,
+                              count=PAGE_SIZE, deadline=None):
+    """
+    从API流式获取电影推荐
+    
+    参数:
+        use_search: 为False时不调用Tavily（输入中已包含足够的本地参考信息）
+        count: 请求的电影数，大于3时多出的电影放入候选池
+        deadline: 请求的截止时间，剩余时间不足时跳过Tavily搜索
+    
+    返回:
+        generator: 模型每输出完一部电影就立即产出该电影，便于提前开始获取海报
+    """
     if use_langchain:
         print("正在使用LangChain方式进行电影推荐...")
-        return langchain_recommender.get_movie_recommendation_langchain(input_text, genre, search_query)
+        yield from langchain_recommender.get_movie_recommendation_langchain(input_text, genre, search_query, session_id, count,
+                                                                            deadline)
+        return
     
     # 使用普通方式推荐
     print("正在使用普通方式进行电影推荐...")
     # 使用Tavily搜索电影信息，优先使用search_query
     search_query = search_query or input_text
     
-    # 使用api_utils中的tavily_search函数
-    movie_info = tavily_search(search_query)
+    # 使用api_utils中的tavily_search函数，并将结果去重、排序、截断后再放入提示词
+    movie_info = None
+    if use_search and deadline is not None and not deadline.allows(DEADLINE_SEARCH_MIN_SECONDS):
+        # 第三级降级：剩余时间几乎用完时不再搜索，把时间留给模型
+        print("【调试信息】剩余时间不足，跳过Tavily搜索")
+        use_search = False
+    if use_search:
+        movie_info = tavily_search(search_query, deadline=deadline)
+        search_context = pack_search_context(movie_info, search_query)
+        print(f"【调试信息】搜索上下文已压缩: {len(json.dumps(movie_info, ensure_ascii=False))} -> {len(search_context)} 字符")
+    else:
+        search_context = "无"
+        print("【调试信息】本地候选已足够，跳过Tavily搜索")
     
     # 构建用户提示词，包含Tavily搜索结果
-    user_prompt = f"根据以下描述推荐三部{genre}电影：{input_text}\nTavily搜索结果：{json.dumps(movie_info, ensure_ascii=False)}\n请按照以下JSON格式返回：{MOVIE_JSON_TEMPLATE}"
+    if count == PAGE_SIZE:
+        count_text, json_template = "三", MOVIE_JSON_TEMPLATE
+    else:
+        count_text, json_template = str(count), get_movie_json_template(count)
+    user_prompt = f"根据以下描述推荐{count_text}部{genre}电影：{input_text}\nTavily搜索结果：\n{search_context}\n请按照以下JSON格式返回：{json_template}"
     print("User prompt:", user_prompt)
     # 获取带历史记录的完整消息列表
-    messages = get_messages_with_history(user_prompt)
+    messages = get_messages_with_history(user_prompt, session_id)
     print(f"【调试信息】即将发送API请求，消息列表包含 {len(messages)} 条消息")
     
-    # 调用 API 获取模型的响应
-    response = client.chat.completions.create(
-        model='deepseek-ai/DeepSeek-R1',
-        messages=messages
-    )
+    # 以流式方式调用 API，推理内容在解析时直接丢弃
+    parser = IncrementalMovieParser()
+    emitted = []
+    for content in iter_deepseek_content(messages, deadline):
+        for movie in parser.feed(content):
+            if not emitted:
+                print("生成的第一部电影名字是:", movie.get('title'))
+            emitted.append(movie)
+            yield movie
+    
+    # 将提到推荐电影的搜索片段收录到遗忘检索索引
+    index_movie_texts(emitted, movie_info)
 
-    # 获取模型的回答
-    model_reply = response.choices[0].message.content
-    model_reply = extract_json_content(model_reply)
+    # 获取模型的完整回答
+    with span("json_extract"):
+        model_reply = extract_json_content(parser.text)
     print("Model response:", model_reply)
     
     # 将模型回答添加到历史记录
-    add_to_history("assistant", model_reply)
+    add_to_history("assistant", model_reply, session_id)
+    
+    if emitted:
+        return
 
-    # 解析模型返回的 JSON 数据
+    # 增量解析没有得到结果时，按完整回答再解析一次
     try:
-        movies_data = json.loads(model_reply)
-        movie_info = movies_data.get("movie_recommendations", [])
-        if movie_info:
-            print("生成的第一部电影名字是:", movie_info[0]['title'])
-        return movie_info
+        with span("json_extract", fallback=True):
+            movies_data = json.loads(model_reply)
+        yield from movies_data.get("movie_recommendations", [])
     except Exception as e:
         print("Error processing response:", e)
-        return []
 
-def get_movie_details(movie, index):
-    """获取单部电影的详细信息，包括海报和IMDb链接"""
+class LLMHedger:
+    """
+    DeepSeek与通义千问之间的对冲请求：先请求所选的模型，一段时间内没有解析出电影（或失败）时同时请求另一个模型，
+    先解析出有效电影的一方胜出，另一方被取消。两个模型各自在临时会话上运行，只有胜出一方的回答写入对话历史。
+    传入请求截止时间时，模型在后台线程中运行，超时后不再等待（即使未启用对冲）。
+    """
+    
+    def __init__(self, delay=HEDGE_DELAY_SECONDS, enabled=HEDGE_ENABLED):
+        """
+        参数:
+            delay: 所选模型多久没有结果后请求另一个模型(秒)
+            enabled: 是否启用对冲请求，未启用时只请求所选的模型
+        """
+        self.delay = delay
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._fork_counter = itertools.count(1)
+        self._first_latency = {}   # 模型名称 -> 首部电影耗时的指数移动平均(秒)
+        self.stats = {"requests": 0, "hedged": 0, "failed": 0, "wins": {}, "latency_saved": 0.0}
+    
+    def _start(self, use_langchain, args, session_id, events, deadline=None):
+        """在后台线程中开始请求一个模型，结果和结束标记(None)放入events队列"""
+        slot = {
+            "fork_id": f"{session_id or DEFAULT_SESSION}#hedge-{next(self._fork_counter)}",
+            # 每个模型使用可单独取消的子截止时间，取消后DeepSeek的流式输出会立即停止
+            "deadline": deadline.child() if deadline is not None else Deadline(),
+            "lock": threading.Lock(),
+            "finished": False,
+            "started_at": time.perf_counter()
+        }
+        fork_history(session_id, slot["fork_id"])
+        # 在当前上下文中运行，后台预取发起的请求仍按后台优先级排队
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run, use_langchain, args, slot, events),
+                         name="llm_request", daemon=True).start()
+        return slot
+    
+    @staticmethod
+    def _run(use_langchain, args, slot, events):
+        input_text, genre, search_query, use_search, count = args
+        results = iter_movie_recommendation(input_text, genre, search_query, use_langchain, slot["fork_id"], use_search, count,
+                                            slot["deadline"])
+        try:
+            for movie in results:
+                if slot["deadline"].expired():
+                    break
+                events.put((use_langchain, movie))
+        except Exception as e:
+            print(f"【调试信息】{get_model_name(use_langchain)} 请求出错: {e}")
+        finally:
+            results.close()
+            with slot["lock"]:
+                slot["finished"] = True
+                if slot["deadline"].cancelled():
+                    discard_fork_history(slot["fork_id"])
+            events.put((use_langchain, None))
+    
+    @staticmethod
+    def _cancel(slot):
+        """取消请求；已结束的请求直接删除临时会话，未结束的在结束时删除（LangChain Agent无法中断，只能等其结束后丢弃）"""
+        with slot["lock"]:
+            slot["deadline"].cancel()
+            if slot["finished"]:
+                discard_fork_history(slot["fork_id"])
+    
+    def _record_win(self, winner, primary, slot, latency):
+        """记录胜出的模型；另一个模型胜出时，按所选模型的平均首部电影耗时估算节省的时间"""
+        winner_name, primary_name = get_model_name(winner), get_model_name(primary)
+        own_latency = time.perf_counter() - slot["started_at"]
+        with self._lock:
+            self.stats["wins"][winner_name] = self.stats["wins"].get(winner_name, 0) + 1
+            average = self._first_latency.get(winner_name)
+            self._first_latency[winner_name] = own_latency if average is None else (
+                average + HEDGE_LATENCY_SMOOTHING * (own_latency - average))
+            saved = 0.0
+            if winner != primary and primary_name in self._first_latency:
+                saved = max(0.0, self._first_latency[primary_name] - latency)
+                self.stats["latency_saved"] += saved
+        print(f"【对冲请求】{winner_name} 胜出，首部电影用时 {latency:.1f}秒" + (f"，估计节省 {saved:.1f}秒" if saved else ""))
+    
+    def iter_recommendation(self, input_text, genre, search_query=None, use_langchain=False, session_id=None,
+                            use_search=True, count=PAGE_SIZE, deadline=None):
+        """
+        参数与iter_movie_recommendation相同，use_langchain指定优先使用的模型
+        
+        返回:
+            generator: 胜出模型的电影，逐部产出；超出截止时间时只产出已得到的电影
+        """
+        if not self.enabled and deadline is None:
+            yield from iter_movie_recommendation(input_text, genre, search_query, use_langchain, session_id, use_search, count)
+            return
+        if deadline is not None and deadline.expired():
+            print("【调试信息】超出请求时间预算，不再请求模型")
+            return
+        
+        hedge = self.enabled
+        args = (input_text, genre, search_query, use_search, count)
+        primary, secondary = use_langchain, not use_langchain
+        events = queue.Queue()
+        start_time = time.perf_counter()
+        slots = {primary: self._start(primary, args, session_id, events, deadline)}
+        finished = set()
+        winner = None
+        emitted = []
+        if hedge:
+            with self._lock:
+                self.stats["requests"] += 1
+        try:
+            while True:
+                waits = []
+                if hedge and winner is None and secondary not in slots:
+                    waits.append(max(0.0, start_time + self.delay - time.perf_counter()))
+                if deadline is not None:
+                    waits.append(deadline.remaining())
+                try:
+                    backend, movie = events.get(timeout=min(waits) if waits else None)
+                except queue.Empty:
+                    if deadline is not None and deadline.expired():
+                        print(f"【调试信息】超出请求时间预算，停止等待模型（已得到 {len(emitted)} 部电影）")
+                        break
+                    print(f"【对冲请求】{get_model_name(primary)} {self.delay:g}秒内没有结果，同时请求 {get_model_name(secondary)}")
+                    slots[secondary] = self._start(secondary, args, session_id, events, deadline)
+                    with self._lock:
+                        self.stats["hedged"] += 1
+                    continue
+                
+                if movie is None:
+                    finished.add(backend)
+                    if backend == winner:
+                        break
+                    if winner is None and hedge and secondary not in slots:
+                        print(f"【对冲请求】{get_model_name(primary)} 没有返回有效结果，改为请求 {get_model_name(secondary)}")
+                        slots[secondary] = self._start(secondary, args, session_id, events, deadline)
+                        with self._lock:
+                            self.stats["hedged"] += 1
+                    elif winner is None and finished == set(slots):
+                        if hedge:
+                            with self._lock:
+                                self.stats["failed"] += 1
+                        break
+                    continue
+                
+                if winner is None:
+                    if not isinstance(movie, dict) or not movie.get("title"):
+                        continue
+                    winner = backend
+                    if hedge:
+                        self._record_win(winner, primary, slots[winner], time.perf_counter() - start_time)
+                    for other, slot in slots.items():
+                        if other != winner:
+                            self._cancel(slot)
+                if backend == winner:
+                    emitted.append(movie)
+                    yield movie
+        finally:
+            # 胜出一方的回答写入对话历史；都失败时保留所选模型的出错记录
+            keep = winner if winner is not None else primary
+            for backend, slot in slots.items():
+                if backend == keep and backend in finished:
+                    adopt_fork_history(slot["fork_id"], session_id)
+                else:
+                    self._cancel(slot)
+            # 超时中断时模型的回答不完整，只记录已展示的电影，保证"换一个"能看到
+            if winner is not None and winner not in finished and emitted:
+                add_to_history("assistant", json.dumps({"movie_recommendations": emitted}, ensure_ascii=False), session_id)
+    
+    def get_stats(self):
+        """获取对冲请求统计"""
+        with self._lock:
+            return dict(self.stats, wins=dict(self.stats["wins"]), first_latency=dict(self._first_latency))
+
+# 创建全局对冲请求实例
+llm_hedger = LLMHedger()
+
+def _normalize_cache_input(value):
+    """规范化缓存键中的输入值：去除字符串首尾空白，数值保留一位小数，列表排序"""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return round(float(value), 1)
+    if isinstance(value, (list, tuple, set)):
+        return sorted(_normalize_cache_input(item) for item in value)
+    return str(value)
+
+def get_model_name(use_langchain=False):
+    """获取推荐使用的模型名称"""
+    return langchain_recommender.LANGCHAIN_MODEL if use_langchain else DEEPSEEK_MODEL
+
+def get_llm_cache_key(mode, inputs, use_langchain=False):
+    """
+    生成模型响应缓存键
+    
+    参数:
+        mode: 推荐模式
+        inputs: 界面输入的字典
+        use_langchain: 是否使用LangChain，决定使用的模型
+    
+    返回:
+        str: 由模式、规范化后的输入、模型和提示词版本计算出的哈希
+    """
+    payload = {
+        "mode": mode,
+        "inputs": {key: _normalize_cache_input(value) for key, value in inputs.items()},
+        "model": get_model_name(use_langchain),
+        "prompt_version": PROMPT_VERSION
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+def iter_cached_movie_recommendation(input_text, genre, search_query=None, use_langchain=False, session_id=None,
+                                     cache_key=None, semantic_query=None, semantic_mode="text", use_search=True,
+                                     count=PAGE_SIZE, deadline=None):
+    """
+    带模型响应缓存的电影推荐
+    
+    参数:
+        cache_key: 精确匹配的响应缓存键，为None时不使用（如"换一个"）
+        semantic_query: 用于语义缓存的自由文本查询，为None时不使用
+        semantic_mode: 语义缓存的推荐模式，不同模式之间不互相复用
+        use_search: 是否调用Tavily
+        count: 请求的电影数
+        deadline: 请求的截止时间，超时后只产出已得到的电影，不完整的结果不写入缓存
+    
+    返回:
+        generator: 命中缓存时直接产出缓存的电影，否则调用模型并在完成后缓存完整结果；
+                   其他会话正在进行相同的请求时等待并共享其结果
+    """
+    cached_movies = None
+    if cache_key:
+        cached_movies = llm_response_cache.get(cache_key)
+        if cached_movies:
+            print(f"【调试信息】命中模型响应缓存: {cache_key[:12]}")
+    
+    semantic_namespace = None
+    if semantic_query and not cached_movies:
+        semantic_namespace = "|".join([semantic_mode, str(genre or ""), get_model_name(use_langchain), PROMPT_VERSION])
+        cached_movies = semantic_cache.lookup(semantic_query, semantic_namespace)
+    
+    if cached_movies:
+        # 命中时也记录推荐摘要，保证"换一个"能看到上一轮推荐
+        add_to_history("assistant", json.dumps({"movie_recommendations": cached_movies}, ensure_ascii=False), session_id)
+        for movie in cached_movies:
+            yield dict(movie)
+        return
+    
+    # 相同的请求正在进行时等待其结果，执行者失败时再自行调用模型
+    flight_key = None
+    if cache_key or semantic_namespace:
+        flight_key = f"{cache_key or semantic_namespace + '|' + normalize_query(semantic_query)}|{count}"
+        future, is_owner = llm_flight.acquire(flight_key)
+        if not is_owner:
+            print(f"【调试信息】等待相同的模型请求: {flight_key[:40]}")
+            try:
+                shared_movies = future.result(timeout=deadline.remaining() if deadline is not None else None)
+            except Exception as e:
+                print(f"【调试信息】相同的模型请求失败，重新请求: {e}")
+                shared_movies = None
+            if shared_movies:
+                add_to_history("assistant", json.dumps({"movie_recommendations": shared_movies}, ensure_ascii=False), session_id)
+                for movie in shared_movies:
+                    yield dict(movie)
+                return
+            flight_key = None
+    
+    movies = []
+    try:
+        for movie in llm_hedger.iter_recommendation(input_text, genre, search_query, use_langchain, session_id, use_search, count,
+                                                    deadline):
+            movies.append(dict(movie))
+            yield movie
+    except BaseException as e:
+        # 包括调用方提前关闭生成器（GeneratorExit），等待者改为自行请求
+        if flight_key:
+            llm_flight.release(flight_key, future, error=e if isinstance(e, Exception) else RuntimeError("请求已取消"))
+        raise
+    
+    if movies and not (deadline is not None and deadline.expired()):
+        if cache_key:
+            llm_response_cache.set(cache_key, movies)
+        if semantic_namespace:
+            semantic_cache.add(semantic_query, semantic_namespace, movies)
+    if flight_key:
+        llm_flight.release(flight_key, future, result=movies)
+
+def iter_catalog_reasons(movies, input_text, use_langchain=False, session_id=None, cache_key=None, deadline=None):
+    """
+    为本地片库选出的电影生成推荐理由
+    
+    参数:
+        movies: 片库选出的电影字典列表，生成的理由会写回其reason字段
+        input_text: 用户的筛选条件
+        cache_key: 精确匹配的响应缓存键，生成完成后缓存完整结果
+        deadline: 请求的截止时间，超时后其余电影使用默认理由
+    
+    返回:
+        generator: 每生成一条推荐理由产出一次该电影的序号
+    """
+    movie_list = "\n".join(
+        f"{i + 1}. {movie['title']}（{movie.get('year', '')}，{movie.get('genre', '')}，评分{movie.get('rating', 'N/A')}）"
+        for i, movie in enumerate(movies)
+    )
+    user_prompt = (f"用户的筛选条件如下：\n{input_text}\n已从片库中选出以下电影，请不要更换电影，只为每部电影写一句推荐理由：\n"
+                   f"{movie_list}\n请按照以下JSON格式返回：{REASON_JSON_TEMPLATE}")
+    messages = get_messages_with_history(user_prompt, session_id)
+    
+    def assign(item, position):
+        """按标题匹配电影，匹配不到时按顺序对应"""
+        for i, movie in enumerate(movies):
+            if item.get("title") and item["title"] == movie["title"]:
+                return i
+        return position if position < len(movies) else None
+    
+    try:
+        if use_langchain:
+            llm, _ = langchain_recommender.get_langchain_agent()
+            if llm is None or (deadline is not None and deadline.expired()):
+                items = []
+            elif deadline is not None:
+                with langchain_recommender.request_deadline(deadline):
+                    items = langchain_recommender.extract_movie_json(llm.invoke(messages, timeout=deadline.remaining()).content)
+            else:
+                items = langchain_recommender.extract_movie_json(llm.invoke(messages).content)
+            for position, item in enumerate(items):
+                i = assign(item, position)
+                if i is not None and item.get("reason"):
+                    movies[i]["reason"] = item["reason"]
+                    yield i
+        else:
+            parser = IncrementalMovieParser()
+            position = 0
+            for content in iter_deepseek_content(messages, deadline):
+                for item in parser.feed(content):
+                    i = assign(item, position)
+                    position += 1
+                    if i is not None and item.get("reason"):
+                        movies[i]["reason"] = item["reason"]
+                        yield i
+        failed = False
+    except Exception as e:
+        # 模型出错或限流排队超时时，已展示的片库电影保留，使用默认理由
+        print(f"【调试信息】生成推荐理由失败，使用默认理由: {e}")
+        failed = True
+    
+    # 没有生成理由的电影使用默认理由，完整结果写入历史；出错时不缓存默认理由
+    for movie in movies:
+        movie["reason"] = get_catalog_reason(movie)
+    add_to_history("assistant", json.dumps({"movie_recommendations": movies}, ensure_ascii=False), session_id)
+    if cache_key and not failed and not (deadline is not None and deadline.expired()):
+        llm_response_cache.set(cache_key, [dict(movie) for movie in movies])
+
+def get_catalog_reason(movie):
+    """片库电影的推荐理由，尚未生成时使用默认理由"""
+    reason = movie.get("reason")
+    if reason and reason != CATALOG_REASON_PLACEHOLDER:
+        return reason
+    return f"符合你的筛选条件的高分{movie.get('genre') or ''}电影"
+
+def get_short_title(title):
+    """获取"中文名(English Name)"格式标题中的中文名"""
+    return re.split(r'[（(]', title or "")[0].strip()
+
+def index_movie_texts(movies, search_result=None):
+    """
+    将电影描述、推荐理由以及提到这些电影的Tavily片段收录到遗忘检索索引
+    
+    参数:
+        movies: 电影字典列表
+        search_result: tavily_search的返回结果，可为None
+    """
+    items = []
+    for movie in movies:
+        reason = movie.get("reason", "")
+        if reason == CATALOG_REASON_PLACEHOLDER:
+            reason = ""
+        items.append({
+            "title": movie.get("title"),
+            "text": f"{movie.get('description', '')} {reason}",
+            "year": movie.get("year", ""),
+            "genre": movie.get("genre", ""),
+            "description": movie.get("description", "")
+        })
+        short_title = get_short_title(movie.get("title"))
+        if len(short_title) < 2 or not search_result:
+            continue
+        for result in search_result.get("results", []):
+            content = result.get("content") or ""
+            if short_title in content or short_title in (result.get("title") or ""):
+                items.append({"title": movie.get("title"), "text": content})
+    fuzzy_index.add_documents(items)
+
+def get_movie_recommendation(input_text, genre, search_query=None, use_langchain=False, session_id=None):
+    """从API获取电影推荐"""
+    return list(iter_movie_recommendation(input_text, genre, search_query, use_langchain, session_id))
+
+def get_movie_details(movie, index, deadline=None):
+    """获取单部电影的详细信息，包括海报和IMDb链接；传入请求截止时间时，剩余时间不足会依次放弃AI海报和真实海报"""
     title = movie.get("title", "Unknown")
     description = movie.get("description", "No description available")
     reason = movie.get("reason", "No reason available")
     rating = movie.get("rating", "N/A")
     
-    # 获取海报和IMDb URL
-    poster_url, imdb_url = get_movie_poster(title)
+    # 获取海报和IMDb URL，同时将电影加入本地片库
+    metadata = get_movie_metadata(title, movie.get("year"), deadline)
+    movie_catalog.add_movie(movie, metadata)
+    poster_url, imdb_url = get_movie_poster(title, metadata)
     if poster_url != "N/A":
-        poster = show_movie_poster(poster_url)
+        poster = show_movie_poster(poster_url, deadline)
     else:
         # 根据电影描述生成海报
         prompt = f"你是一位海报设计师。请根据以下电影描述生成一张海报：{description}。请在海报右下角清晰标注此图像由AI生成，非原始海报。"
-        poster = generate_image_ByAI(prompt)
+        poster = get_ai_poster(title, movie.get("year"), prompt, deadline)
     
     return {
         f"title{index}": title,
@@ -114,32 +656,395 @@ def get_movie_details(movie, index):
         f"imdb_url{index}": imdb_url
     }
 
-def recommend_text(input_text, genre, search_query=None, use_langchain=False):
-    """主处理函数，整合推荐和海报功能"""
+def get_text_movie_details(movie, index, imdb_url="无法找到电影网址，请重试"):
+    """只包含文字信息、不带海报的电影详情，用于海报返回前的先行展示和出错时的兜底"""
+    return {
+        f"title{index}": movie.get("title", "Unknown"),
+        f"description{index}": movie.get("description", "No description available"),
+        f"poster{index}": None,
+        f"reason{index}": movie.get("reason", "No reason available"),
+        f"rating{index}": movie.get("rating", "N/A"),
+        f"imdb_url{index}": imdb_url
+    }
+
+def _apply_movie_details(result, future, i, movie):
+    """将电影详情任务的结果写入结果字典；文字信息已先行返回，这里只更新海报和IMDb链接，出错时保留文字信息"""
     try:
-        # 将用户输入添加到历史记录
-        add_to_history("user", f"我需要{genre}类型的电影推荐：{input_text}")
-        
-        # 获取电影推荐
-        movie_info = get_movie_recommendation(input_text, genre, search_query, use_langchain)
+        details = future.result()
+        result.update({key: details[key] for key in (f"poster{i}", f"imdb_url{i}")})
+    except Exception as e:
+        print(f"【调试信息】获取第 {i + 1} 部电影详情失败: {e}")
+        result.update(get_text_movie_details(movie, i))
+
+def iter_completed_details(result, pending, deadline):
+    """
+    每个详情任务完成后更新一次结果；超出截止时间时不再等待，未完成的电影只保留文字信息
+    
+    参数:
+        pending: 详情任务 -> (序号, 电影)
+    """
+    applied = set()
+    try:
+        for future in as_completed(pending, timeout=deadline.remaining()):
+            i, movie = pending[future]
+            _apply_movie_details(result, future, i, movie)
+            applied.add(future)
+            yield dict(result)
+    except FuturesTimeoutError:
+        unfinished = [future for future in pending if future not in applied]
+        print(f"【调试信息】超出请求时间预算，不再等待 {len(unfinished)} 部电影的海报")
+        for future in unfinished:
+            i, movie = pending[future]
+            if future.done():
+                _apply_movie_details(result, future, i, movie)
+            else:
+                result.update(get_text_movie_details(movie, i))
+        yield dict(result)
+
+class MovieDetailStream:
+    """
+    在后台线程中读取模型逐部输出的电影，同时等待已提交的详情任务：下一部电影和完成的详情任务哪个先到就先处理哪个，
+    使已展示电影的海报不必等到模型输出下一部电影（如候选池中的电影）时才更新
+    """
+    
+    def __init__(self, movies, deadline, model_deadline=None):
+        """
+        参数:
+            movies: 模型推荐的电影生成器（片库推荐时为每生成一条推荐理由产出的电影序号）
+            deadline: 请求的截止时间，超时后不再等待
+            model_deadline: 传给模型的子截止时间，调用方提前结束时取消，使模型尽快停止输出
+        """
+        self.deadline = deadline
+        self.model_deadline = model_deadline
+        self._events = queue.Queue()
+        self._stop = threading.Event()
+        self._watching = 0
+        # 在当前上下文中运行，请求优先级和请求追踪随之传递
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._produce, movies), name="movie_stream", daemon=True)
+        self._thread.start()
+    
+    def _produce(self, movies):
+        """逐部读取电影放入事件队列，结束时放入结束标记(None)，出错时放入异常"""
+        try:
+            for movie in movies:
+                if self._stop.is_set():
+                    break
+                self._events.put(("movie", movie))
+        except Exception as e:
+            self._events.put(("error", e))
+        finally:
+            movies.close()
+            self._events.put(("movie", None))
+    
+    def watch(self, future, index, movie):
+        """关注一个详情任务，完成时产出("detail", (详情任务, 序号, 电影))"""
+        self._watching += 1
+        future.add_done_callback(lambda future: self._events.put(("detail", (future, index, movie))))
+    
+    def __iter__(self):
+        """
+        返回:
+            generator: ("movie", 电影)或("detail", (详情任务, 序号, 电影))；模型输出结束且关注的详情任务都完成，
+                       或超出截止时间时停止
+        """
+        movies_done = False
+        try:
+            while not movies_done or self._watching:
+                try:
+                    kind, item = self._events.get(timeout=self.deadline.remaining())
+                except queue.Empty:
+                    print("【调试信息】超出请求时间预算，停止等待模型输出和海报")
+                    return
+                if kind == "error":
+                    raise item
+                if kind == "movie" and item is None:
+                    movies_done = True
+                    continue
+                if kind == "detail":
+                    self._watching -= 1
+                yield kind, item
+        finally:
+            if not movies_done:
+                # 调用方提前结束（如预取被取消）时停止模型输出，并在截止时间内等待其结束，
+                # 避免模型在调用方清理临时会话后才写入历史记录
+                self._stop.set()
+                if self.model_deadline is not None:
+                    self.model_deadline.cancel()
+                self._thread.join(self.deadline.remaining())
+
+class CandidatePool:
+    """按会话保存模型多推荐的候选电影，"换一个"时逐页取出，下一页的海报在后台提前获取"""
+    
+    def __init__(self, page_size=PAGE_SIZE, max_workers=DETAIL_FETCH_WORKERS):
+        """
+        参数:
+            page_size: 每页的电影数
+            max_workers: 后台获取海报的线程数
+        """
+        self.page_size = page_size
+        self._pools = {}  # 会话ID -> {"movies": 尚未预取的候选, "next_page": [(电影, 详情任务)], "use_langchain"}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="candidate_pool")
+    
+    def _prefetch_page(self, pool):
+        """取出下一页候选并在后台开始获取海报（调用方需持有锁）"""
+        page = pool["movies"][:self.page_size]
+        del pool["movies"][:self.page_size]
+        # 提前获取的海报是推测性请求，按后台优先级排队
+        pool["next_page"] = [(movie, self._executor.submit(run_in_background, get_movie_details, movie, i))
+                             for i, movie in enumerate(page)]
+    
+    def set(self, session_id, movies, use_langchain=False):
+        """保存会话的候选电影（替换旧的候选），并预取第一页的海报"""
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            self._discard(session_id)
+            if not movies:
+                return
+            pool = {"movies": list(movies), "next_page": [], "use_langchain": use_langchain}
+            self._prefetch_page(pool)
+            self._pools[session_id] = pool
+        print(f"【调试信息】候选池已保存 {len(movies)} 部电影")
+    
+    def _discard(self, session_id):
+        """删除会话的候选，取消尚未开始的海报任务（调用方需持有锁）"""
+        pool = self._pools.pop(session_id, None)
+        if pool:
+            for _, future in pool["next_page"]:
+                future.cancel()
+    
+    def clear(self, session_id):
+        """用户发起新查询时清空会话的候选"""
+        with self._lock:
+            self._discard(session_id or DEFAULT_SESSION)
+    
+    def adopt(self, fork_id, session_id):
+        """将临时会话（如预取）的候选移到真实会话，替换其旧的候选"""
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            pool = self._pools.pop(fork_id, None)
+            if pool is None:
+                return
+            self._discard(session_id)
+            self._pools[session_id] = pool
+    
+    def next_page(self, session_id, use_langchain=False):
+        """
+        取出下一页候选，并开始预取再下一页的海报
         
-        # 如果没有获取到电影信息，返回错误
-        if not movie_info:
-            return {"error": "没有找到符合条件的电影推荐。"}
+        返回:
+            list: [(电影, 详情任务)]；没有候选或推荐方式不同时返回None
+        """
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            pool = self._pools.get(session_id)
+            if not pool or pool["use_langchain"] != use_langchain or not pool["next_page"]:
+                self._discard(session_id)
+                return None
+            page = pool["next_page"]
+            self._prefetch_page(pool)
+            if not pool["next_page"]:
+                del self._pools[session_id]
+            return page
+    
+    def remaining(self, session_id):
+        """会话剩余的候选电影数"""
+        with self._lock:
+            pool = self._pools.get(session_id or DEFAULT_SESSION)
+            return len(pool["movies"]) + len(pool["next_page"]) if pool else 0
+
+# 创建全局候选池实例
+candidate_pool = CandidatePool()
+
+def recommend_pool_page(page, session_id=None, deadline=None):
+    """
+    展示候选池中的一页电影：先返回文字信息，再随每张海报完成逐步更新
+    
+    参数:
+        page: CandidatePool.next_page返回的[(电影, 详情任务)]
+        deadline: 请求的截止时间，默认从现在起REQUEST_SLO_SECONDS秒
+    
+    返回:
+        generator: 逐步更新的结果字典
+    """
+    titles = "、".join(movie.get("title", "") for movie, _ in page)
+    record_user_reaction(f"不喜欢，已改看候选：{titles}", session_id)
+    
+    result = {}
+    for i, (movie, _) in enumerate(page):
+        result.update(get_text_movie_details(movie, i, imdb_url="正在获取..."))
+    yield dict(result)
+    
+    futures = {future: (i, movie) for i, (movie, future) in enumerate(page)}
+    yield from iter_completed_details(result, futures, deadline or Deadline())
+
+def recommend_text_stream(input_text, genre, search_query=None, use_langchain=False, max_workers=None, session_id=None,
+                          cache_key=None, semantic_query=None, semantic_mode="text", catalog_movies=None,
+                          preview_movies=None, use_search=True, exclude_titles=None, pool_size=None, deadline=None):
+    """
+    流式处理函数：模型每输出完一部电影就先返回其文字信息并开始获取海报，再随每张海报完成逐步更新
+    
+    参数:
+        catalog_movies: 从本地片库选出的电影，传入时立即展示，模型只生成推荐理由
+        preview_movies: 模型回答前先行展示的本地候选电影，模型输出的电影会逐个替换它们，没有被替换的在模型输出结束后清除
+        use_search: 是否调用Tavily
+        exclude_titles: 本会话已展示过的电影标题，要求模型不再推荐并过滤掉
+        pool_size: 请求模型推荐的电影数，多出的电影放入候选池，默认使用CANDIDATE_POOL_SIZE
+        deadline: 请求的截止时间，默认从现在起REQUEST_SLO_SECONDS秒；各阶段按剩余时间降级，超时后返回已有的结果
+    
+    返回:
+        generator: 每次产出当前完整的结果字典，出错时产出包含error字段的字典
+    """
+    deadline = deadline or Deadline()
+    try:
+        # 将用户输入添加到历史记录，"换一个"时把用户反应记到上一轮推荐摘要中；新查询清空旧的候选池
+        if input_text == FEEDBACK_PROMPT:
+            record_user_reaction("不喜欢，要求换一批", session_id)
+        else:
+            candidate_pool.clear(session_id)
+        add_to_history("user", f"我需要{genre}类型的电影推荐：{input_text}", session_id)
+        if exclude_titles:
+            input_text += f"\n请不要推荐以下已经推荐过的电影：{'、'.join(exclude_titles)}"
         
-        # 处理每部电影的详细信息
         result = {}
-        for i, movie in enumerate(movie_info[:3]):  # 最多处理3部电影
-            movie_details = get_movie_details(movie, i)
-            result.update(movie_details)
+        movies = []
+        extra_movies = []
+        if preview_movies:
+            for i, movie in enumerate(preview_movies[:3]):
+                result.update(get_text_movie_details(movie, i, imdb_url="正在确认..."))
+            yield dict(result)
         
-        return result
+        # 详情任务在提交时的上下文中执行，后台预取发起的海报请求仍按后台优先级排队
+        executor = ThreadPoolExecutor(max_workers=max(1, max_workers or DETAIL_FETCH_WORKERS))
+        try:
+            pending = {}  # 尚未更新到结果中的详情任务 -> (序号, 电影)
+            if catalog_movies:
+                # 片库中的电影立即展示并开始获取海报，推荐理由生成一条更新一条，海报完成时同样立即更新
+                movies.extend(catalog_movies[:3])
+                model_deadline = deadline.child()
+                stream = MovieDetailStream(iter_catalog_reasons(movies, input_text, use_langchain, session_id, cache_key,
+                                                                model_deadline),
+                                           deadline, model_deadline)
+                for i, movie in enumerate(movies):
+                    future = executor.submit(contextvars.copy_context().run, get_movie_details, movie, i, deadline)
+                    pending[future] = (i, movie)
+                    stream.watch(future, i, movie)
+                    result.update(get_text_movie_details(movie, i, imdb_url="正在获取..."))
+                yield dict(result)
+                for kind, item in stream:
+                    if kind == "detail":
+                        future, i, movie = item
+                        del pending[future]
+                        _apply_movie_details(result, future, i, movie)
+                    else:
+                        i = item
+                        result[f"reason{i}"] = movies[i]["reason"]
+                    yield dict(result)
+                # 生成失败或超出截止时间仍未生成的理由使用默认理由
+                reasons = {f"reason{i}": get_catalog_reason(movie) for i, movie in enumerate(movies)}
+                if any(result[key] != reason for key, reason in reasons.items()):
+                    result.update(reasons)
+                    yield dict(result)
+            else:
+                # 获取电影推荐，每解析出一部电影就提交海报获取任务，与模型生成后续电影并行；
+                # 每张海报完成时立即更新，不必等待模型输出下一部电影
+                count = max(PAGE_SIZE, pool_size or CANDIDATE_POOL_SIZE)
+                model_deadline = deadline.child()
+                stream = MovieDetailStream(iter_cached_movie_recommendation(input_text, genre, search_query, use_langchain,
+                                                                            session_id, cache_key, semantic_query,
+                                                                            semantic_mode, use_search, count, model_deadline),
+                                           deadline, model_deadline)
+                for kind, item in stream:
+                    if kind == "detail":
+                        future, i, movie = item
+                        del pending[future]
+                        _apply_movie_details(result, future, i, movie)
+                        yield dict(result)
+                        continue
+                    movie = item
+                    if exclude_titles and movie.get("title") in exclude_titles:
+                        print(f"【调试信息】跳过已推荐过的电影: {movie.get('title')}")
+                        continue
+                    if len(movies) >= 3:
+                        # 多出的电影放入候选池
+                        extra_movies.append(movie)
+                        continue
+                    i = len(movies)
+                    movies.append(movie)
+                    future = executor.submit(contextvars.copy_context().run, get_movie_details, movie, i, deadline)
+                    pending[future] = (i, movie)
+                    stream.watch(future, i, movie)
+                    # 先返回标题、评分和推荐理由
+                    result.update(get_text_movie_details(movie, i, imdb_url="正在获取..."))
+                    yield dict(result)
+                if movies and preview_movies and len(movies) < len(preview_movies[:3]):
+                    # 模型确认的电影少于先行展示的本地候选时，清除没有被替换的候选
+                    for i in range(len(movies), len(preview_movies[:3])):
+                        for key in get_text_movie_details({}, i):
+                            result.pop(key, None)
+                    yield dict(result)
+            
+            # 如果没有获取到电影信息，返回错误
+            if not movies:
+                yield {"error": "推荐超时，请重试。" if deadline.expired() else "没有找到符合条件的电影推荐。"}
+                return
+            index_movie_texts(movies + extra_movies)
+            if extra_movies:
+                candidate_pool.set(session_id, extra_movies, use_langchain)
+            
+            # 每部电影的详细信息完成后更新一次，单部电影出错时保留文字信息
+            yield from iter_completed_details(result, pending, deadline)
+        finally:
+            # 超时未完成的任务不再等待，它们在后台结束后结果仍会写入缓存
+            executor.shutdown(wait=False, cancel_futures=True)
         
     except Exception as e:
         print("Error in processing: 来自推荐的警告", e)
-        return {"error": "处理推荐时出错，请重试。"}
+        yield {"error": "处理推荐时出错，请重试。"}
+
+def recommend_text(input_text, genre, search_query=None, use_langchain=False, max_workers=None, stream=False, session_id=None,
+                   cache_key=None, semantic_query=None, semantic_mode="text", catalog_movies=None,
+                   preview_movies=None, use_search=True, exclude_titles=None, pool_size=None, deadline=None):
+    """
+    主处理函数，整合推荐和海报功能
+    
+    参数:
+        stream: 为True时返回逐步更新结果的生成器
+        session_id: Gradio会话标识
+        cache_key: 精确匹配的模型响应缓存键
+        semantic_query: 用于语义缓存的自由文本查询
+        semantic_mode: 语义缓存的推荐模式
+        catalog_movies: 从本地片库选出的电影
+        preview_movies: 模型回答前先行展示的本地候选电影
+        use_search: 是否调用Tavily
+        exclude_titles: 本会话已展示过的电影标题
+        pool_size: 请求模型推荐的电影数，多出的电影放入候选池
+        deadline: 请求的截止时间
+    """
+    results = recommend_text_stream(input_text, genre, search_query, use_langchain, max_workers, session_id,
+                                    cache_key, semantic_query, semantic_mode, catalog_movies,
+                                    preview_movies, use_search, exclude_titles, pool_size, deadline)
+    if stream:
+        return results
+    
+    result = {"error": "处理推荐时出错，请重试。"}
+    for result in results:
+        pass
+    return result
+
+def get_catalog_movie(record):
+    """将片库记录转换为与模型输出相同格式的电影字典"""
+    return {
+        "title": record["title"],
+        "genre": "/".join(record.get("genres", [])),
+        "year": str(record.get("year") or ""),
+        "description": record.get("description") or "No description available",
+        "reason": CATALOG_REASON_PLACEHOLDER,
+        "rating": str(record["rating"]) if record.get("rating") is not None else "N/A"
+    }
 
-def recommend_filter(genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain=False):
+def recommend_filter(genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain=False, stream=False, session_id=None):
     """多维度筛选推荐函数"""
     # 如果 genre 是列表，则将其转为逗号分隔的字符串
     genre_str = ",".join(genre) if isinstance(genre, list) else genre
@@ -155,23 +1060,71 @@ def recommend_filter(genre, year_range, rating_range, is_hot, is_free, is_vip, i
         f"地区：{region}\n"
     )
     
-    # 构建适合搜索的查询
-    search_query = f"热门电影 {genre_str} {language} {region} {year_range.split('-')[0]}年 推荐"
+    # 构建适合搜索的查询（年代滑块返回的是数值）
+    search_query = f"热门电影 {genre_str} {language} {region} {str(year_range).split('-')[0]}年 推荐"
+    
+    # 输入完全由筛选条件决定，相同条件复用模型响应
+    cache_key = get_llm_cache_key("filter", {
+        "genre": genre if isinstance(genre, list) else [genre],
+        "year_range": year_range, "rating_range": rating_range,
+        "is_hot": is_hot, "is_free": is_free, "is_vip": is_vip, "is_paid": is_paid,
+        "language": language, "region": region
+    }, use_langchain)
     
-    return recommend_text(input_text, genre, search_query, use_langchain)
+    # 片库无法判断热播和播放权益，勾选这些条件或已有缓存时不走片库
+    catalog_movies = None
+    if not (is_hot or is_free or is_vip or is_paid) and llm_response_cache.get(cache_key) is None:
+        candidates = movie_catalog.find_movies(
+            genres=genre if isinstance(genre, list) else [genre] if genre else None,
+            min_year=year_range, min_rating=rating_range, language=language, region=region, limit=3
+        )
+        if len(candidates) >= CATALOG_MIN_CANDIDATES:
+            print(f"【调试信息】片库命中 {len(candidates)} 部电影，模型只生成推荐理由")
+            catalog_movies = [get_catalog_movie(record) for record in candidates]
+    
+    return recommend_text(input_text, genre, search_query, use_langchain, stream=stream, session_id=session_id,
+                          cache_key=cache_key, catalog_movies=catalog_movies)
 
-def recommend_fuzzy(description, use_langchain=False):
+def get_shortlist_movie(candidate):
+    """将本地索引候选转换为与模型输出相同格式的电影字典"""
+    return {
+        "title": candidate["title"],
+        "genre": candidate["genre"],
+        "year": candidate["year"],
+        "description": candidate["description"] or "No description available",
+        "reason": f"本地资料匹配度 {candidate['coverage']:.0%}，正在等待模型确认...",
+        "rating": "N/A"
+    }
+
+def recommend_fuzzy(description, use_langchain=False, stream=False, session_id=None):
     """遗忘检索推荐函数"""
     input_text = f"我看过一部电影但现在忘记了。请根据以下描述帮我找到这部电影：\n{description}"
     
     # 从描述中提取关键词用于搜索
     # 简单处理：移除常见的介绍性词语，保留实质内容
-    search_query = description.replace("这部电影", "").replace("记得", "").replace("好像", "").strip()
-    search_query = f"电影 {search_query} 推荐"
+    keywords = description.replace("这部电影", "").replace("记得", "").replace("好像", "").strip()
+    search_query = f"电影 {keywords} 推荐"
     
-    return recommend_text(input_text, '', search_query, use_langchain)
+    # 先在本地索引中检索候选电影：立即展示，并作为参考交给模型；最佳候选足够匹配时不再调用Tavily
+    shortlist = [candidate for candidate in fuzzy_index.search(keywords, limit=FUZZY_SHORTLIST_SIZE)
+                 if candidate["coverage"] >= FUZZY_MIN_COVERAGE]
+    preview_movies = None
+    use_search = True
+    if shortlist:
+        print(f"【调试信息】本地索引候选: {[(c['title'], round(c['coverage'], 2)) for c in shortlist]}")
+        candidate_lines = "\n".join(
+            f"- {c['title']}（{c['year'] or '年份未知'}）：{c['description'][:80]}" for c in shortlist
+        )
+        input_text += f"\n本地资料中与描述最相关的候选电影（仅供参考，可能都不是）：\n{candidate_lines}"
+        preview_movies = [get_shortlist_movie(candidate) for candidate in shortlist[:3]]
+        use_search = shortlist[0]["coverage"] < FUZZY_SKIP_SEARCH_COVERAGE
+    
+    # 相似的描述复用过去的检索结果
+    return recommend_text(input_text, '', search_query, use_langchain, stream=stream, session_id=session_id,
+                          semantic_query=description, semantic_mode="fuzzy",
+                          preview_movies=preview_movies, use_search=use_search)
 
-def recommend_emotional(emotion, environment, location, atmosphere, use_langchain=False):
+def recommend_emotional(emotion, environment, location, atmosphere, use_langchain=False, stream=False, session_id=None):
     """情感交互推荐函数"""
     input_text = (
         f"情感：{emotion}\n"
@@ -183,7 +1136,12 @@ def recommend_emotional(emotion, environment, location, atmosphere, use_langchai
     # 构建适合搜索的查询
     search_query = f"电影推荐 {emotion} {atmosphere} {location} 适合 {environment}"
     
-    return recommend_text(input_text, "", search_query, use_langchain)
+    # 输入完全由下拉选项决定，相同选项复用模型响应
+    cache_key = get_llm_cache_key("emotional", {
+        "emotion": emotion, "environment": environment, "location": location, "atmosphere": atmosphere
+    }, use_langchain)
+    
+    return recommend_text(input_text, "", search_query, use_langchain, stream=stream, session_id=session_id, cache_key=cache_key)
 
 # 测试函数，用于比较普通方式和LangChain方式的推荐效果
 def test_recommendation_methods(input_text="", genre="科幻", search_query=None):
@@ -0,0 +1,230 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import zlib
+import numpy as np
+
+# 语义缓存配置，可在.env中覆盖
+SEMANTIC_CACHE_DIR = "semantic_cache"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))    # 余弦相似度达到该值才复用结果
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))  # 最多保留的查询数
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))               # 缓存过期时间(秒)，默认1天
+SEMANTIC_CACHE_FLUSH_SECONDS = float(os.getenv("SEMANTIC_CACHE_FLUSH_SECONDS", "30"))  # 新增条目最多延迟多久写入磁盘(秒)
+
+# 向量化配置：字符n-gram哈希到固定维度
+EMBEDDING_DIM = 2048
+NGRAM_SIZES = (1, 2, 3)
+
+# 对语义没有帮助的常见口语词，向量化前去除，使"轻松的喜剧"和"想看轻松喜剧片"更接近
+FILLER_WORDS = ["我想看", "想看", "给我", "帮我", "推荐", "一部", "几部", "一些", "电影", "影片", "请", "吧", "的", "片"]
+
+def normalize_query(text):
+    """规范化查询：小写、去除标点、空白和口语词"""
+    text = re.sub(r'[\s\W_]+', '', text.lower())
+    for word in FILLER_WORDS:
+        text = text.replace(word, "")
+    return text
+
+def embed_query(text):
+    """
+    将查询向量化（字符n-gram哈希，仅依赖CPU和NumPy）
+
+    返回:
+        np.ndarray: L2归一化后的float32向量，文本为空时为全零向量
+    """
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    text = normalize_query(text)
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            hash_value = zlib.crc32(text[i:i + n].encode('utf-8'))
+            # 用哈希的最高位决定符号，减少哈希冲突带来的偏差；较长的n-gram权重更高
+            sign = 1.0 if hash_value & 0x80000000 else -1.0
+            vector[hash_value % EMBEDDING_DIM] += sign * n
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+class SemanticCache:
+    """本地语义缓存：相似的查询复用过去的模型结果，条目数有上限并持久化到磁盘"""
+
+    def __init__(self, cache_dir=SEMANTIC_CACHE_DIR, threshold=SEMANTIC_CACHE_THRESHOLD,
+                 max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl_seconds=SEMANTIC_CACHE_TTL,
+                 flush_seconds=SEMANTIC_CACHE_FLUSH_SECONDS):
+        """
+        参数:
+            cache_dir: 持久化目录
+            threshold: 复用结果所需的最低余弦相似度
+            max_entries: 最多保留的查询数，超出时淘汰最久未使用的查询
+            ttl_seconds: 条目过期时间(秒)
+            flush_seconds: 新增条目后最多延迟多久写入磁盘，期间的多次新增合并为一次写入
+        """
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._vectors = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        self._entries = []  # 与向量一一对应：{"namespace", "query", "value", "created_at", "last_used"}
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()   # 定时写入和退出时写入不能同时写同一个文件
+        self._dirty = False
+        self._flush_timer = None
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+        atexit.register(self.flush)
+
+    def _get_paths(self):
+        return os.path.join(self.cache_dir, "vectors.npy"), os.path.join(self.cache_dir, "entries.json")
+
+    def _load(self):
+        """从磁盘加载索引"""
+        vectors_path, entries_path = self._get_paths()
+        if not (os.path.exists(vectors_path) and os.path.exists(entries_path)):
+            return
+        try:
+            vectors = np.load(vectors_path)
+            with open(entries_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if vectors.shape != (len(data["entries"]), EMBEDDING_DIM):
+                print("[语义缓存] 索引文件不一致，已忽略")
+                return
+            self._vectors = vectors.astype(np.float32)
+            self._entries = data["entries"]
+            self.hits = data.get("hits", 0)
+            self.misses = data.get("misses", 0)
+            print(f"[语义缓存] 已加载 {len(self._entries)} 条缓存")
+        except Exception as e:
+            print(f"[语义缓存] 加载缓存失败: {e}")
+
+    def _mark_dirty(self):
+        """标记有未保存的修改，flush_seconds秒后合并写入磁盘（调用方需持有锁）"""
+        self._dirty = True
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_seconds, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """将未保存的修改写入磁盘，由定时器和退出时调用"""
+        with self._save_lock:
+            with self._lock:
+                self._flush_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                # 向量矩阵只会被整体替换，不会原地修改，可直接在锁外写入
+                vectors = self._vectors
+                data = {"entries": [dict(entry) for entry in self._entries], "hits": self.hits, "misses": self.misses}
+            self._save(vectors, data)
+
+    def _save(self, vectors, data):
+        """将索引写入磁盘"""
+        vectors_path, entries_path = self._get_paths()
+        try:
+            with open(f"{vectors_path}.tmp", 'wb') as f:
+                np.save(f, vectors)
+            with open(f"{entries_path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(f"{vectors_path}.tmp", vectors_path)
+            os.replace(f"{entries_path}.tmp", entries_path)
+        except OSError as e:
+            print(f"[语义缓存] 保存缓存失败: {e}")
+
+    def _best_match(self, vector, namespace):
+        """返回同一命名空间内未过期的最相似条目的(序号, 相似度)（调用方需持有锁）"""
+        if not self._entries:
+            return -1, 0.0
+        similarities = self._vectors @ vector
+        now = time.time()
+        for i, entry in enumerate(self._entries):
+            if entry["namespace"] != namespace or now - entry["created_at"] > self.ttl_seconds:
+                similarities[i] = -1.0
+        best = int(np.argmax(similarities))
+        return best, float(similarities[best])
+
+    def lookup(self, query, namespace):
+        """
+        查找相似查询的缓存结果
+
+        参数:
+            query: 用户的自由文本查询
+            namespace: 命名空间（推荐模式、类型、模型等），只在相同命名空间内匹配
+
+        返回:
+            缓存的结果，未命中时返回None
+        """
+        vector = embed_query(query)
+        with self._lock:
+            best, similarity = self._best_match(vector, namespace)
+            if best >= 0 and similarity >= self.threshold:
+                self.hits += 1
+                entry = self._entries[best]
+                entry["last_used"] = time.time()
+                print(f"[语义缓存] 命中: '{query}' ≈ '{entry['query']}' (相似度 {similarity:.2f})")
+                return entry["value"]
+            self.misses += 1
+            return None
+
+    def add(self, query, namespace, value):
+        """添加查询结果，与已有查询几乎相同时覆盖原条目"""
+        vector = embed_query(query)
+        if not vector.any():
+            return
+        now = time.time()
+        entry = {"namespace": namespace, "query": query, "value": value, "created_at": now, "last_used": now}
+        with self._lock:
+            best, similarity = self._best_match(vector, namespace)
+            if best >= 0 and similarity >= 0.99:
+                self._entries[best] = entry
+            else:
+                self._entries.append(entry)
+                self._vectors = np.vstack([self._vectors, vector[np.newaxis, :]])
+            self._evict()
+            self._mark_dirty()
+
+    def _evict(self):
+        """删除过期条目，超出上限时淘汰最久未使用的条目（调用方需持有锁）"""
+        now = time.time()
+        keep = [i for i, entry in enumerate(self._entries) if now - entry["created_at"] <= self.ttl_seconds]
+        if len(keep) > self.max_entries:
+            keep.sort(key=lambda i: self._entries[i]["last_used"])
+            keep = sorted(keep[len(keep) - self.max_entries:])
+        if len(keep) != len(self._entries):
+            self._entries = [self._entries[i] for i in keep]
+            self._vectors = self._vectors[keep]
+
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "threshold": self.threshold
+            }
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries = []
+            self._vectors = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+            self._dirty = True
+        self.flush()
+
+# 创建全局语义缓存实例
+semantic_cache = SemanticCache()
+
+# 查看缓存统计：python semantic_cache.py；清空缓存：python semantic_cache.py --clear
+if __name__ == "__main__":
+    import sys
+
+    if "--clear" in sys.argv:
+        semantic_cache.clear()
+        print("[语义缓存] 已清空")
+    print(f"[语义缓存] 统计: {semantic_cache.stats()}")
@@ -1,8 +1,41 @@
 import gradio as gr
 from recommendation import recommend_text, recommend_filter, recommend_fuzzy, recommend_emotional
+from prefetch import feedback_prefetcher, recommend_feedback
+from metrics import traced, get_current_trace, start_metrics_server
+
+def build_outputs(result):
+    """将推荐结果字典转换为界面组件的输出，尚未返回的海报显示为空"""
+    if "error" in result:
+        return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", ""
+    
+    outputs = []
+    for i in range(3):
+        poster = result.get(f"poster{i}")
+        outputs.extend([
+            [poster] if poster is not None else [],
+            result.get(f"reason{i}", ""),
+            result.get(f"title{i}", ""),
+            result.get(f"rating{i}", ""),
+            result.get(f"imdb_url{i}", "")
+        ])
+    return outputs
+
+def stream_outputs(results, handler):
+    """逐步输出推荐结果：先显示文字信息，每张海报完成后再单独更新；整个过程记为一次请求追踪"""
+    return traced(handler, _iter_outputs(results))
+
+def _iter_outputs(results):
+    result = {}
+    for result in results:
+        yield build_outputs(result)
+    if "error" not in result:
+        print("顺利完成！！")
+    else:
+        get_current_trace().outcome = "error"
 
 # Gradio界面组件
 def create_ui():
+    start_metrics_server()
     with gr.Blocks(theme=gr.themes.Ocean()) as demo:
         gr.HTML("<h1 style='font-size: 24px; text-align: center;'>电影推荐官</h1>")
 
@@ -33,21 +66,11 @@ def create_ui():
                     movie2_imdb_url = gr.Textbox(label="电影网址")
             recommend_button_feedback = gr.Button("换一个", variant="primary")
             
-            def process(input_text, genre, use_langchain):
-                result = recommend_text(input_text, genre, use_langchain=use_langchain)
-                if "error" in result:
-                    return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", "", ""
-                else:
-                    print("顺利完成！！")
-                    return [result["poster0"]], result["reason0"], result["title0"], result["rating0"], result["imdb_url0"], [result["poster1"]], result["reason1"], result["title1"], result["rating1"], result["imdb_url1"], [result["poster2"]], result["reason2"], result["title2"], result["rating2"], result["imdb_url2"]
+            def process(input_text, genre, use_langchain, request: gr.Request):
+                yield from stream_outputs(feedback_prefetcher.track(recommend_text(input_text, genre, use_langchain=use_langchain, stream=True, session_id=request.session_hash, semantic_query=input_text), request.session_hash, use_langchain), "text")
             
-            def process2(text_input, genre, use_langchain):
-                result = recommend_text("The user didn't like your previous recommendation. Please recommend another movie and reduce recommendations of this type in the future.", "", use_langchain=use_langchain) 
-                if "error" in result:
-                    return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", "", ""
-                else:
-                    print("顺利完成！！")
-                    return [result["poster0"]], result["reason0"], result["title0"], result["rating0"], result["imdb_url0"], [result["poster1"]], result["reason1"], result["title1"], result["rating1"], result["imdb_url1"], [result["poster2"]], result["reason2"], result["title2"], result["rating2"], result["imdb_url2"]
+            def process2(text_input, genre, use_langchain, request: gr.Request):
+                yield from stream_outputs(recommend_feedback(use_langchain=use_langchain, session_id=request.session_hash), "feedback")
             
             recommend_button.click(process, inputs=[text_input, genre, use_langchain], outputs=[recommend_output0, movie0_reason, movie0_title, movie0_rating, movie0_imdb_url, recommend_output1, movie1_reason, movie1_title, movie1_rating, movie1_imdb_url, recommend_output2, movie2_reason, movie2_title, movie2_rating, movie2_imdb_url])
             recommend_button_feedback.click(process2, inputs=[text_input, genre, use_langchain], outputs=[recommend_output0, movie0_reason, movie0_title, movie0_rating, movie0_imdb_url, recommend_output1, movie1_reason, movie1_title, movie1_rating, movie1_imdb_url, recommend_output2, movie2_reason, movie2_title, movie2_rating, movie2_imdb_url])
@@ -87,21 +110,11 @@ def create_ui():
                     movie2_imdb_url = gr.Textbox(label="电影网址")
             filter_button_feedback = gr.Button("换一个",variant="primary")
 
-            def process(genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain):
-                result = recommend_filter(genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain=use_langchain)
-                if "error" in result:
-                    return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", "", ""
-                else:
-                    print("顺利完成！！")
-                    return [result["poster0"]], result["reason0"], result["title0"], result["rating0"], result["imdb_url0"], [result["poster1"]], result["reason1"], result["title1"], result["rating1"], result["imdb_url1"], [result["poster2"]], result["reason2"], result["title2"], result["rating2"], result["imdb_url2"]
+            def process(genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain, request: gr.Request):
+                yield from stream_outputs(feedback_prefetcher.track(recommend_filter(genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain=use_langchain, stream=True, session_id=request.session_hash), request.session_hash, use_langchain), "filter")
             
-            def process2(genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain):
-                result = recommend_text("The user didn't like your previous recommendation. Please recommend another movie and reduce recommendations of this type in the future.", "", use_langchain=use_langchain) 
-                if "error" in result:
-                    return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", "", ""
-                else:
-                    print("顺利完成！！")
-                    return [result["poster0"]], result["reason0"], result["title0"], result["rating0"], result["imdb_url0"], [result["poster1"]], result["reason1"], result["title1"], result["rating1"], result["imdb_url1"], [result["poster2"]], result["reason2"], result["title2"], result["rating2"], result["imdb_url2"]
+            def process2(genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain, request: gr.Request):
+                yield from stream_outputs(recommend_feedback(use_langchain=use_langchain, session_id=request.session_hash), "feedback")
             
             filter_button.click(fn=process, inputs=[genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain], outputs=[recommend_output0, movie0_reason, movie0_title, movie0_rating, movie0_imdb_url, recommend_output1, movie1_reason, movie1_title, movie1_rating, movie1_imdb_url, recommend_output2, movie2_reason, movie2_title, movie2_rating, movie2_imdb_url])
             filter_button_feedback.click(fn=process2, inputs=[genre, year_range, rating_range, is_hot, is_free, is_vip, is_paid, language, region, use_langchain], outputs=[recommend_output0, movie0_reason, movie0_title, movie0_rating, movie0_imdb_url, recommend_output1, movie1_reason, movie1_title, movie1_rating, movie1_imdb_url, recommend_output2, movie2_reason, movie2_title, movie2_rating, movie2_imdb_url])
@@ -131,21 +144,11 @@ def create_ui():
                     movie2_imdb_url = gr.Textbox(label="电影网址")
             search_button_feedback = gr.Button("换一个",variant="primary")
             
-            def process(description, use_langchain):
-                result = recommend_fuzzy(description, use_langchain=use_langchain)
-                if "error" in result:
-                    return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", "", ""
-                else:
-                    print("顺利完成！！")
-                    return [result["poster0"]], result["reason0"], result["title0"], result["rating0"], result["imdb_url0"], [result["poster1"]], result["reason1"], result["title1"], result["rating1"], result["imdb_url1"], [result["poster2"]], result["reason2"], result["title2"], result["rating2"], result["imdb_url2"]
+            def process(description, use_langchain, request: gr.Request):
+                yield from stream_outputs(feedback_prefetcher.track(recommend_fuzzy(description, use_langchain=use_langchain, stream=True, session_id=request.session_hash), request.session_hash, use_langchain), "fuzzy")
             
-            def process2(description, use_langchain):
-                result = recommend_text("The user didn't like your previous recommendation. Please recommend another movie and reduce recommendations of this type in the future.", "", use_langchain=use_langchain) 
-                if "error" in result:
-                    return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", "", ""
-                else:
-                    print("顺利完成！！")
-                    return [result["poster0"]], result["reason0"], result["title0"], result["rating0"], result["imdb_url0"], [result["poster1"]], result["reason1"], result["title1"], result["rating1"], result["imdb_url1"], [result["poster2"]], result["reason2"], result["title2"], result["rating2"], result["imdb_url2"]
+            def process2(description, use_langchain, request: gr.Request):
+                yield from stream_outputs(recommend_feedback(use_langchain=use_langchain, session_id=request.session_hash), "feedback")
             
             search_button.click(fn=process, inputs=[description, use_langchain], outputs=[recommend_output0, movie0_reason, movie0_title, movie0_rating, movie0_imdb_url, recommend_output1, movie1_reason, movie1_title, movie1_rating, movie1_imdb_url, recommend_output2, movie2_reason, movie2_title, movie2_rating, movie2_imdb_url])
             search_button_feedback.click(fn=process2, inputs=[description, use_langchain], outputs=[recommend_output0, movie0_reason, movie0_title, movie0_rating, movie0_imdb_url, recommend_output1, movie1_reason, movie1_title, movie1_rating, movie1_imdb_url, recommend_output2, movie2_reason, movie2_title, movie2_rating, movie2_imdb_url])
@@ -178,21 +181,11 @@ def create_ui():
                     movie2_imdb_url = gr.Textbox(label="电影网址")
             emotional_button_feedback = gr.Button("换一个",variant="primary")
             
-            def process(emotion, environment, location, atmosphere, use_langchain):
-                result = recommend_emotional(emotion, environment, location, atmosphere, use_langchain=use_langchain)
-                if "error" in result:
-                    return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", "", ""
-                else:
-                    print("顺利完成！！")
-                    return [result["poster0"]], result["reason0"], result["title0"], result["rating0"], result["imdb_url0"], [result["poster1"]], result["reason1"], result["title1"], result["rating1"], result["imdb_url1"], [result["poster2"]], result["reason2"], result["title2"], result["rating2"], result["imdb_url2"]
+            def process(emotion, environment, location, atmosphere, use_langchain, request: gr.Request):
+                yield from stream_outputs(feedback_prefetcher.track(recommend_emotional(emotion, environment, location, atmosphere, use_langchain=use_langchain, stream=True, session_id=request.session_hash), request.session_hash, use_langchain), "emotional")
             
-            def process2(emotion, environment, location, atmosphere, use_langchain):
-                result = recommend_text("The user didn't like your previous recommendation. Please recommend another movie and reduce recommendations of this type in the future.", "", use_langchain=use_langchain) 
-                if "error" in result:
-                    return [], result["error"], "", "", "", [], "", "", "", "", [], "", "", "", "", ""
-                else:
-                    print("顺利完成！！")
-                    return [result["poster0"]], result["reason0"], result["title0"], result["rating0"], result["imdb_url0"], [result["poster1"]], result["reason1"], result["title1"], result["rating1"], result["imdb_url1"], [result["poster2"]], result["reason2"], result["title2"], result["rating2"], result["imdb_url2"]
+            def process2(emotion, environment, location, atmosphere, use_langchain, request: gr.Request):
+                yield from stream_outputs(recommend_feedback(use_langchain=use_langchain, session_id=request.session_hash), "feedback")
             
             emotional_button.click(fn=process, inputs=[emotion, environment, location, atmosphere, use_langchain], outputs=[recommend_output0, movie0_reason, movie0_title, movie0_rating, movie0_imdb_url, recommend_output1, movie1_reason, movie1_title, movie1_rating, movie1_imdb_url, recommend_output2, movie2_reason, movie2_title, movie2_rating, movie2_imdb_url])
             emotional_button_feedback.click(fn=process2, inputs=[emotion, environment, location, atmosphere, use_langchain], outputs=[recommend_output0, movie0_reason, movie0_title, movie0_rating, movie0_imdb_url, recommend_output1, movie1_reason, movie1_title, movie1_rating, movie1_imdb_url, recommend_output2, movie2_reason, movie2_title, movie2_rating, movie2_imdb_url])